@@ -0,0 +1,920 @@
+"""
+Benchmarks for the vehicle counter in number-of-car.py
+
+Usage:
+    python number-of-car-benchmark.py soak --hours 48
+    python number-of-car-benchmark.py detect-every traffic.mp4 --max-interval 5
+    python number-of-car-benchmark.py backends traffic.mp4 --backends torch,onnx,openvino-int8
+    python number-of-car-benchmark.py synthesize traffic.mp4 --seconds 120
+    python number-of-car-benchmark.py suite --report report.json --baseline baseline.json
+    python number-of-car-benchmark.py scaling --model yolov8n.pt --max-instances 4
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+
+def load_vehicle_counter():
+    """Import number-of-car.py, whose file name is not a valid module name"""
+    if 'number_of_car' in sys.modules:
+        return sys.modules['number_of_car']
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'number-of-car.py')
+    spec = importlib.util.spec_from_file_location('number_of_car', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['number_of_car'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+if __name__ == '__mp_main__':
+    # Processes the counter spawns (frame decoding, clip encoding) unpickle
+    # their target from number_of_car, so it has to be importable in them
+    load_vehicle_counter()
+
+
+def current_rss_mb():
+    """Resident set size of this process right now, in MB"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except OSError:
+        # Not Linux: fall back to the peak, which still shows unbounded growth
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+class FakeTensor:
+    """Just enough of the torch.Tensor API for VehicleCounter to read results"""
+
+    def __init__(self, array):
+        self.array = array
+
+    def cpu(self):
+        return self
+
+    def int(self):
+        return FakeTensor(self.array.astype(np.int32))
+
+    def numpy(self):
+        return self.array
+
+    def tolist(self):
+        return self.array.tolist()
+
+
+class FakeBoxes:
+    def __init__(self, xywh, track_ids, class_ids, confidences):
+        self.xywh = FakeTensor(xywh)
+        self.id = FakeTensor(track_ids) if track_ids is not None else None
+        self.cls = FakeTensor(class_ids)
+        self.conf = FakeTensor(confidences)
+
+
+class FakeResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+# Size (w, h) and BGR colour of each vehicle class in synthetic videos. The
+# colours are far apart, so PixelTracker can tell them apart after lossy
+# encoding, and far from the grey road in brightness too, so the motion
+# gate, which only sees greyscale, notices them
+VEHICLE_STYLES = {
+    2: ((60, 100), (160, 40, 20)),     # car
+    3: ((34, 56), (40, 200, 40)),      # motorcycle
+    5: ((90, 230), (40, 200, 230)),    # bus
+    7: ((84, 180), (240, 60, 240)),    # truck
+}
+VEHICLE_NAMES = {2: 'car', 3: 'motorcycle', 5: 'bus', 7: 'truck'}
+
+
+def truth_path(video_path):
+    """Ground truth file written next to a synthetic video"""
+    return os.path.splitext(video_path)[0] + '.truth.json'
+
+
+def make_traffic_video(path, seconds=60, fps=30, width=1280, height=720,
+                       vehicles_per_minute=40, line_position=0.5, seed=0):
+    """
+    Write a synthetic traffic video and its ground truth crossings
+
+    Vehicles are solid rectangles driving along fixed lanes over a grey road
+    with a little sensor noise; lanes on the left drive down and lanes on the
+    right drive up, each at its own steady speed, so vehicles never overlap.
+    The ground truth lists every vehicle whose centre crosses the counting
+    line, with the frame it crosses on.
+
+    Args:
+        path (str): Video file to write (.mp4)
+        seconds (float): Length of the video
+        fps (int): Frame rate
+        width (int): Frame width in pixels
+        height (int): Frame height in pixels
+        vehicles_per_minute (float): Mean rate vehicles enter the frame
+        line_position (float): Counting line as a fraction of frame height
+        seed (int): Random seed; the same arguments always give the same video
+
+    Returns:
+        dict: The ground truth, also saved to truth_path(path)
+    """
+    rng = np.random.default_rng(seed)
+    lanes = max(2, width // 160)
+    lane_x = (np.arange(lanes) + 0.5) * width / lanes
+    lane_dir = np.where(np.arange(lanes) < lanes / 2, 1, -1)
+    lane_speed = rng.uniform(4, 14, lanes)
+    spawn_rate = vehicles_per_minute / 60 / fps / lanes
+    line_y = int(height * line_position)
+
+    road = np.full((height, width, 3), 100, dtype=np.int16)
+    for x in (lane_x[:-1] + lane_x[1:]) / 2:
+        road[:, int(x) - 2:int(x) + 2] = 230
+    # A few frames of sensor noise, cycled; fresh noise per frame is slow to make
+    noisy_roads = [np.clip(road + rng.integers(-4, 5, (height, width, 1)), 0, 255)
+                   .astype(np.uint8) for _ in range(8)]
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    vehicles = []   # every vehicle spawned: lane, class, y, entry frame, crossing frame
+    active = []
+    last_in_lane = [None] * lanes
+    total_frames = int(seconds * fps)
+    try:
+        for frame_index in range(total_frames):
+            for lane in range(lanes):
+                if rng.random() >= spawn_rate:
+                    continue
+                class_id = int(rng.choice(list(VEHICLE_STYLES), p=[0.6, 0.15, 0.1, 0.15]))
+                (_, h), _ = VEHICLE_STYLES[class_id]
+                last = last_in_lane[lane]
+                if last is not None:
+                    (_, last_h), _ = VEHICLE_STYLES[last['class_id']]
+                    travelled = (frame_index - last['entry_frame']) * lane_speed[lane]
+                    if travelled < (h + last_h) / 2 + 40:
+                        continue  # no room behind the previous vehicle yet
+                start_y = -h / 2 if lane_dir[lane] > 0 else height + h / 2
+                vehicle = {'id': len(vehicles) + 1, 'lane': lane, 'class_id': class_id,
+                           'entry_frame': frame_index, 'y': start_y, 'cross_frame': None}
+                vehicles.append(vehicle)
+                active.append(vehicle)
+                last_in_lane[lane] = vehicle
+
+            frame = noisy_roads[frame_index % len(noisy_roads)].copy()
+            still_active = []
+            for vehicle in active:
+                lane = vehicle['lane']
+                previous_y = vehicle['y']
+                if frame_index > vehicle['entry_frame']:
+                    vehicle['y'] += lane_speed[lane] * lane_dir[lane]
+                y = vehicle['y']
+                if vehicle['cross_frame'] is None and frame_index > vehicle['entry_frame']:
+                    if (lane_dir[lane] > 0 and previous_y < line_y <= y
+                            or lane_dir[lane] < 0 and previous_y > line_y >= y):
+                        vehicle['cross_frame'] = frame_index
+                (w, h), color = VEHICLE_STYLES[vehicle['class_id']]
+                x1, y1 = int(lane_x[lane] - w / 2), int(y - h / 2)
+                frame[max(y1, 0):max(y1 + h, 0), x1:x1 + w] = color
+                if -h < y < height + h:
+                    still_active.append(vehicle)
+            active = still_active
+            writer.write(frame)
+    finally:
+        writer.release()
+
+    crossed = [vehicle for vehicle in vehicles if vehicle['cross_frame'] is not None]
+    counts = {name: 0 for name in VEHICLE_NAMES.values()}
+    for vehicle in crossed:
+        counts[VEHICLE_NAMES[vehicle['class_id']]] += 1
+    truth = {
+        'video': os.path.basename(path),
+        'fps': fps, 'width': width, 'height': height, 'frames': total_frames,
+        'seed': seed, 'line_position': line_position,
+        'total_vehicles': len(crossed),
+        'vehicle_count': counts,
+        'crossings': [{'id': vehicle['id'], 'vehicle_type': VEHICLE_NAMES[vehicle['class_id']],
+                       'direction': 'down' if lane_dir[vehicle['lane']] > 0 else 'up',
+                       'frame': vehicle['cross_frame']} for vehicle in crossed],
+    }
+    with open(truth_path(path), 'w') as f:
+        json.dump(truth, f, indent=1)
+    return truth
+
+
+class PixelTracker:
+    """
+    Deterministic stand-in for a YOLO model on synthetic traffic videos
+
+    Finds the coloured rectangles of make_traffic_video() with a colour
+    threshold and contours on a half-size frame, and links them frame to frame by
+    nearest centre, handing out new track IDs the way ByteTrack does. It
+    answers model.predict() and model.track() with results shaped like
+    Ultralytics', so every VehicleCounter path (ROI crops, tiles, the motion
+    gate, BoxTracker) runs unchanged, on a CPU and without model weights.
+    """
+
+    def __init__(self, tolerance=50, min_area=200, max_distance=60, max_lost=5, scale=2):
+        """
+        Args:
+            tolerance (int): Per-channel colour difference still matched to a class
+            min_area (int): Smallest box, in full-frame pixels, reported as a vehicle
+            max_distance (float): Furthest a centre may move between frames
+            max_lost (int): Frames a track survives without a detection
+            scale (int): Detect on frames shrunk by this factor, for speed
+        """
+        self.ranges = [(class_id, np.clip(np.array(color) - tolerance, 0, 255).astype(np.uint8),
+                        np.clip(np.array(color) + tolerance, 0, 255).astype(np.uint8))
+                       for class_id, (_, color) in VEHICLE_STYLES.items()]
+        self.min_area = min_area
+        self.max_distance = max_distance
+        self.max_lost = max_lost
+        self.scale = scale
+        self.next_id = 1
+        # Tracks: centre x, y, class ID, track ID, frames since last seen
+        self.tracks = np.empty((0, 5))
+
+    def detect(self, frame):
+        """Boxes of one frame as (xywh, class IDs)"""
+        height, width = frame.shape[:2]
+        small = cv2.resize(frame, (width // self.scale, height // self.scale),
+                           interpolation=cv2.INTER_NEAREST)
+        boxes = []
+        classes = []
+        for class_id, lower, upper in self.ranges:
+            mask = cv2.inRange(small, lower, upper)
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            for contour in contours:
+                x, y, w, h = (value * self.scale for value in cv2.boundingRect(contour))
+                if w * h >= self.min_area:
+                    boxes.append((x + w / 2, y + h / 2, w, h))
+                    classes.append(class_id)
+        return np.array(boxes, dtype=np.float32).reshape(-1, 4), np.array(classes, dtype=np.int64)
+
+    def predict(self, source, **kwargs):
+        frames = source if isinstance(source, list) else [source]
+        results = []
+        for frame in frames:
+            xywh, class_ids = self.detect(frame)
+            results.append(FakeResult(FakeBoxes(xywh, None, class_ids,
+                                                np.full(len(xywh), 0.9, dtype=np.float32))))
+        return results
+
+    def track(self, source, **kwargs):
+        frames = source if isinstance(source, list) else [source]
+        results = []
+        for frame in frames:
+            xywh, class_ids = self.detect(frame)
+            track_ids = self._link(xywh, class_ids)
+            results.append(FakeResult(FakeBoxes(xywh, track_ids, class_ids,
+                                                np.full(len(xywh), 0.9, dtype=np.float32))))
+        return results
+
+    def tracker_state(self):
+        """Track state for VehicleCounter checkpoints"""
+        return {'next_id': self.next_id, 'tracks': self.tracks.copy()}
+
+    def restore_tracker_state(self, state):
+        self.next_id = state['next_id']
+        self.tracks = state['tracks'].copy()
+
+    def _link(self, xywh, class_ids):
+        """Track ID for each box, matching the closest tracks first"""
+        track_ids = np.zeros(len(xywh), dtype=np.int64)
+        tracks = self.tracks
+        matched = np.zeros(len(tracks), dtype=bool)
+        if len(tracks) and len(xywh):
+            distance = np.hypot(xywh[:, None, 0] - tracks[None, :, 0],
+                                xywh[:, None, 1] - tracks[None, :, 1])
+            distance[class_ids[:, None] != tracks[None, :, 2]] = np.inf
+            for flat in np.argsort(distance, axis=None):
+                box, track = np.unravel_index(flat, distance.shape)
+                if distance[box, track] > self.max_distance:
+                    break
+                if track_ids[box] or matched[track]:
+                    continue
+                track_ids[box] = tracks[track, 3]
+                matched[track] = True
+
+        new = track_ids == 0
+        track_ids[new] = np.arange(self.next_id, self.next_id + new.sum())
+        self.next_id += int(new.sum())
+
+        # Keep unmatched tracks for a few frames, in case a detection was missed
+        kept = tracks[~matched]
+        kept[:, 4] += 1
+        kept = kept[kept[:, 4] <= self.max_lost]
+        seen = np.column_stack([xywh[:, :2], class_ids, track_ids, np.zeros(len(xywh))])
+        self.tracks = np.concatenate([seen.reshape(-1, 5), kept])
+        return track_ids
+
+
+class TrackOnlyModel:
+    """
+    A model with nothing but track(), the least VehicleCounter accepts
+
+    Keeps the suite counting with such a model, which gets no warm-up.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def track(self, source, **kwargs):
+        return self.model.track(source, **kwargs)
+
+
+class SoakTraffic:
+    """
+    Endless stand-in for model.track: vehicles driving down through the frame
+
+    Every vehicle gets a fresh track ID, the way ByteTrack hands them out, and
+    a share of them park for a while instead of moving. Frames are ignored,
+    so the soak exercises counting and track state, not the model.
+    """
+
+    def __init__(self, frame_height=1080, vehicles_per_minute=60, fps=30,
+                 parked_share=0.1, seed=0):
+        self.frame_height = frame_height
+        self.spawn_rate = vehicles_per_minute / 60 / fps
+        self.parked_share = parked_share
+        self.rng = np.random.default_rng(seed)
+        self.next_id = 1
+        self.moving_spawned = 0
+
+        # Active vehicles: x, y, speed (px/frame), frames left, track ID, class ID
+        self.active = np.empty((0, 6))
+
+    def _spawn(self):
+        count = self.rng.poisson(self.spawn_rate)
+        if count == 0:
+            return
+        parked = self.rng.random(count) < self.parked_share
+        new = np.empty((count, 6))
+        new[:, 0] = self.rng.uniform(100, 1800, count)
+        new[:, 1] = np.where(parked, self.rng.uniform(100, self.frame_height - 100, count), -40)
+        new[:, 2] = np.where(parked, 0, self.rng.uniform(6, 20, count))
+        travel = (self.frame_height + 80) / np.maximum(new[:, 2], 1)
+        new[:, 3] = np.where(parked, self.rng.integers(300, 3000, count), travel)
+        new[:, 4] = np.arange(self.next_id, self.next_id + count)
+        new[:, 5] = self.rng.choice([2, 3, 5, 7], count)
+        self.next_id += count
+        self.moving_spawned += int((~parked).sum())
+        self.active = np.concatenate([self.active, new])
+
+    def _next(self):
+        self._spawn()
+        self.active[:, 1] += self.active[:, 2]
+        self.active[:, 3] -= 1
+        self.active = self.active[self.active[:, 3] > 0]
+
+        count = len(self.active)
+        xywh = np.empty((count, 4), dtype=np.float32)
+        xywh[:, :2] = self.active[:, :2]
+        xywh[:, 2:] = 80
+        return FakeResult(FakeBoxes(xywh, self.active[:, 4], self.active[:, 5],
+                                    np.full(count, 0.9, dtype=np.float32)))
+
+    def track(self, frames, **kwargs):
+        return [self._next() for _ in frames]
+
+
+def run_soak(args):
+    """Feed days of synthetic traffic through the counter and watch memory"""
+    vc = load_vehicle_counter()
+    traffic = SoakTraffic(vehicles_per_minute=args.vehicles_per_minute, fps=args.fps)
+    counter = vc.VehicleCounter(model=traffic, max_track_age=args.max_track_age)
+    counter.setup_counting_line(traffic.frame_height)
+
+    total_frames = int(args.hours * 3600 * args.fps)
+    sample_every = max(total_frames // args.samples, args.batch_size)
+    frames = [None] * args.batch_size
+    samples = []
+    start = time.time()
+
+    print(f"Soaking {args.hours:g} h of video ({total_frames} frames) at "
+          f"{args.vehicles_per_minute} vehicles/min")
+    print(f"{'video time':>10} {'RSS MB':>8} {'tracks':>7} {'counted':>8} {'fps':>8}")
+
+    for frame_index in range(0, total_frames, args.batch_size):
+        counter.detect_and_count_batch(frames, annotate=False)
+        if frame_index % sample_every < args.batch_size:
+            rss = current_rss_mb()
+            elapsed = time.time() - start
+            samples.append((frame_index, rss, len(counter.track_history)))
+            print(f"{frame_index / args.fps / 3600:>9.1f}h {rss:>8.1f} "
+                  f"{len(counter.track_history):>7} {counter.total_vehicles:>8} "
+                  f"{frame_index / max(elapsed, 1e-9):>8.0f}")
+
+    # Compare against memory once the store has warmed up, not at start-up
+    baseline_rss = samples[len(samples) // 10][1]
+    final_rss = max(sample[1] for sample in samples[len(samples) // 10:])
+    growth = (final_rss - baseline_rss) / baseline_rss
+    missed = traffic.moving_spawned - counter.total_vehicles
+
+    print("-" * 48)
+    print(f"Track IDs issued: {traffic.next_id - 1}, peak tracks held: "
+          f"{max(sample[2] for sample in samples)} (capacity {counter.track_history.capacity})")
+    print(f"RSS after warm-up: {baseline_rss:.1f} MB, peak later: {final_rss:.1f} MB "
+          f"({growth * 100:+.1f}%)")
+    print(f"Moving vehicles: {traffic.moving_spawned}, counted: {counter.total_vehicles} "
+          f"({missed} still in frame or missed)")
+
+    if growth > args.max_growth:
+        print(f"FAIL: memory grew more than {args.max_growth * 100:.0f}%")
+        return 1
+    print("PASS: memory stayed flat")
+    return 0
+
+
+def count_errors(counts, reference):
+    """Per-class count differences from a reference, summed"""
+    classes = set(counts) | set(reference)
+    return sum(abs(counts.get(name, 0) - reference.get(name, 0)) for name in classes)
+
+
+def timed_count(counter, args):
+    """
+    Count args.video without display, returning the result and seconds taken
+
+    Model warm-up happens before processing and isn't in the seconds.
+    """
+    # Keep process_video's progress and stage reports out of the benchmark's output
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = counter.process_video(args.video, display_video=False,
+                                       batch_size=args.batch_size,
+                                       line_position=args.line_position)
+    elapsed = result['timing']['processing']
+    print(f"{result['total_vehicles']} vehicles, {result['frames'] / max(elapsed, 1e-9):.1f} fps "
+          f"(warm-up {result['timing']['warm_up']:.2f}s)")
+    return result, elapsed
+
+
+def print_comparison(rows, reference_name, ground_truth=None):
+    """
+    Table of fps and count accuracy, relative to the first row
+
+    Args:
+        rows (list): (config name, process_video result, seconds) per config
+        reference_name (str): What the first row is, for the footnote
+        ground_truth (int): Known vehicle total to score against instead
+    """
+    reference = rows[0][1]['vehicle_count']
+    reference_total = ground_truth or rows[0][1]['total_vehicles']
+    base_fps = rows[0][1]['frames'] / max(rows[0][2], 1e-9)
+    print("-" * 60)
+    print(f"{'config':<14} {'fps':>8} {'speed-up':>9} {'vehicles':>9} {'errors':>7} {'accuracy':>9}")
+    for name, result, elapsed in rows:
+        fps = result['frames'] / max(elapsed, 1e-9)
+        if ground_truth:
+            errors = abs(result['total_vehicles'] - ground_truth)
+        else:
+            errors = count_errors(result['vehicle_count'], reference)
+        accuracy = max(0.0, 1 - errors / max(reference_total, 1))
+        print(f"{name:<14} {fps:>8.1f} {fps / base_fps:>8.2f}x {result['total_vehicles']:>9} "
+              f"{errors:>7} {accuracy * 100:>8.1f}%")
+    if ground_truth:
+        print(f"Errors are differences from the ground truth total of {ground_truth}")
+    else:
+        print(f"Errors are per-class count differences from {reference_name}")
+
+
+def run_detect_every(args):
+    """Compare model.track on every frame with detecting every N frames"""
+    vc = load_vehicle_counter()
+    model = vc.YOLO(args.model)
+    configs = [('model.track', None)] + [(f'every {n}', n)
+                                         for n in range(1, args.max_interval + 1)]
+
+    rows = []
+    for name, interval in configs:
+        counter = vc.VehicleCounter(model_path=args.model, model=model,
+                                    confidence_threshold=args.confidence)
+        if interval is not None:
+            counter.box_tracker = vc.BoxTracker(interval)
+        print(f"{name}: ", end='', flush=True)
+        rows.append((name,) + timed_count(counter, args))
+
+    print_comparison(rows, 'model.track on every frame', args.ground_truth)
+    return 0
+
+
+def run_backends(args):
+    """Compare inference backends on the same clip"""
+    vc = load_vehicle_counter()
+    rows = []
+    for name in args.backends.split(','):
+        backend, _, variant = name.partition('-')
+        # Load (and export on first use) before timing starts
+        model = vc.load_model(args.model, backend, variant == 'int8')
+        counter = vc.VehicleCounter(model_path=args.model, model=model,
+                                    confidence_threshold=args.confidence)
+        print(f"{name}: ", end='', flush=True)
+        rows.append((name,) + timed_count(counter, args))
+
+    print_comparison(rows, rows[0][0], args.ground_truth)
+    return 0
+
+
+# Configurations the suite compares: process_video arguments, plus
+# motion_gate, detect_every, output and clips, which set up the counter
+SUITE_CONFIGS = {
+    'serial': {},
+    'batch-8': {'batch_size': 8},
+    'pipelined': {'pipelined': True, 'batch_size': 8},
+    'decode-process': {'decode_process': True, 'batch_size': 8},
+    'motion-gate': {'motion_gate': True},
+    'detect-every-3': {'detect_every': 3},
+    'output': {'output': True},
+    'clips': {'clips': True},
+    'track-only': {'track_only': True},
+}
+SUITE_STAGES = ('decode', 'inference', 'postprocess', 'annotate', 'encode')
+
+
+def count_config(video, config, line_position, work_dir):
+    """
+    Count a synthetic video with PixelTracker under one suite configuration
+
+    Meant to run in a fresh process, so the peak RSS is this
+    configuration's alone.
+
+    Returns:
+        dict: Counts, frames, seconds, per-stage timing and peak RSS in MB
+    """
+    vc = load_vehicle_counter()
+    options = dict(config)
+    model = PixelTracker()
+    if options.pop('track_only', False):
+        model = TrackOnlyModel(model)
+    counter = vc.VehicleCounter(model=model)
+    if options.pop('motion_gate', False):
+        counter.motion_gate = vc.MotionGate()
+    detect_every = options.pop('detect_every', None)
+    if detect_every:
+        counter.box_tracker = vc.BoxTracker(detect_every)
+    output_path = None
+    if options.pop('output', False):
+        output_path = os.path.join(work_dir, 'output.mp4')
+    if options.pop('clips', False):
+        counter.clip_recorder = vc.ClipRecorder(os.path.join(work_dir, 'clips'),
+                                                stage_timer=counter.stage_timer)
+
+    # Keep process_video's progress and stage reports out of the benchmark's output
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = counter.process_video(video, output_path, display_video=False,
+                                       line_position=line_position, **options)
+    elapsed = result['timing']['processing']
+
+    stages = {name: {key: float(value) for key, value in stage.items()}
+              for name, stage in counter.stage_timer.summary().items()}
+    return {
+        'frames': result['frames'],
+        'seconds': elapsed,
+        'warm_up_seconds': result['timing']['warm_up'],
+        'fps': result['frames'] / max(elapsed, 1e-9),
+        'total_vehicles': result['total_vehicles'],
+        'vehicle_count': result['vehicle_count'],
+        'stages': stages,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3,
+    }
+
+
+def _run_and_report(results, target, args):
+    try:
+        results.put(target(*args))
+    except BaseException as e:
+        results.put(RuntimeError(f"{type(e).__name__}: {e}"))
+
+
+def run_isolated(target, *args):
+    """Call target(*args) in a fresh spawned process and return its result"""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    # Not a daemon, so configurations that start processes of their own can
+    # still spawn children
+    process = context.Process(target=_run_and_report, args=(results, target, args))
+    process.start()
+    try:
+        while True:
+            try:
+                result = results.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f"Benchmark process exited with code {process.exitcode}")
+    finally:
+        process.join()
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def run_concurrently(calls):
+    """
+    Run (target, args) calls at the same time, each in a fresh spawned process
+
+    Returns:
+        list: The calls' results, in order
+    """
+    context = multiprocessing.get_context('spawn')
+    started = []
+    for target, args in calls:
+        results = context.Queue()
+        process = context.Process(target=_run_and_report, args=(results, target, args))
+        process.start()
+        started.append((process, results))
+
+    outcomes = []
+    try:
+        for process, results in started:
+            while True:
+                try:
+                    outcomes.append(results.get(timeout=1.0))
+                    break
+                except queue.Empty:
+                    if not process.is_alive():
+                        raise RuntimeError(f"Benchmark process exited with code {process.exitcode}")
+    finally:
+        for process, _ in started:
+            if process.is_alive() and len(outcomes) < len(started):
+                process.terminate()
+            process.join()
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            raise outcome
+    return outcomes
+
+
+def check_regressions(report, baseline, max_slowdown, max_rss_growth):
+    """
+    Compare a suite report with a saved one
+
+    Returns:
+        list: A message for each configuration that got slower, used more
+              memory or counted less accurately than in the baseline
+    """
+    failures = []
+    for name, row in report['configs'].items():
+        before = baseline['configs'].get(name)
+        if before is None:
+            continue
+        if row['fps'] < before['fps'] * (1 - max_slowdown):
+            failures.append(f"{name}: {row['fps']:.1f} fps, was {before['fps']:.1f}")
+        if row['peak_rss_mb'] > before['peak_rss_mb'] * (1 + max_rss_growth):
+            failures.append(f"{name}: peak RSS {row['peak_rss_mb']:.0f} MB, "
+                            f"was {before['peak_rss_mb']:.0f}")
+        if row['errors'] > before['errors']:
+            failures.append(f"{name}: {row['errors']} count errors, was {before['errors']}")
+    return failures
+
+
+def run_synthesize(args):
+    """Write a synthetic traffic video with its ground truth"""
+    truth = make_traffic_video(args.output, args.seconds, args.fps, args.width, args.height,
+                               args.vehicles_per_minute, args.line_position, args.seed)
+    print(f"Wrote {args.output}: {truth['frames']} frames, {truth['total_vehicles']} "
+          f"crossings; ground truth in {truth_path(args.output)}")
+    return 0
+
+
+def run_suite(args):
+    """Count a synthetic video under each configuration and report speed, memory and accuracy"""
+    configs = args.configs.split(',') if args.configs else list(SUITE_CONFIGS)
+    unknown = [name for name in configs if name not in SUITE_CONFIGS]
+    if unknown:
+        print(f"Unknown configurations: {', '.join(unknown)}; "
+              f"choose from {', '.join(SUITE_CONFIGS)}")
+        return 2
+
+    with tempfile.TemporaryDirectory(prefix='vehicle-bench-') as work_dir:
+        video = args.video
+        if video is None:
+            video = os.path.join(work_dir, 'traffic.mp4')
+            print(f"Generating {args.seconds:g}s of {args.width}x{args.height} synthetic traffic")
+            make_traffic_video(video, args.seconds, args.fps, args.width, args.height,
+                               args.vehicles_per_minute, args.line_position, args.seed)
+        with open(truth_path(video)) as f:
+            truth = json.load(f)
+
+        rows = {}
+        for name in configs:
+            print(f"{name}: ", end='', flush=True)
+            config_dir = os.path.join(work_dir, name)
+            os.makedirs(config_dir)
+            row = run_isolated(count_config, video, SUITE_CONFIGS[name],
+                               truth['line_position'], config_dir)
+            row['errors'] = count_errors(row['vehicle_count'], truth['vehicle_count'])
+            row['accuracy'] = max(0.0, 1 - row['errors'] / max(truth['total_vehicles'], 1))
+            rows[name] = row
+            print(f"{row['total_vehicles']} vehicles, {row['fps']:.1f} fps")
+
+    print("-" * 100)
+    stage_header = ' '.join(f"{stage[:8]:>8}" for stage in SUITE_STAGES)
+    print(f"{'config':<15} {'fps':>7} {'RSS MB':>7} {'vehicles':>8} {'errors':>6} "
+          f"{'accuracy':>8}  {stage_header}")
+    for name, row in rows.items():
+        stage_ms = ' '.join(f"{row['stages'][stage]['mean'] * 1e3:>8.2f}"
+                            if stage in row['stages'] else f"{'-':>8}"
+                            for stage in SUITE_STAGES)
+        print(f"{name:<15} {row['fps']:>7.1f} {row['peak_rss_mb']:>7.0f} "
+              f"{row['total_vehicles']:>8} {row['errors']:>6} {row['accuracy'] * 100:>7.1f}%  "
+              f"{stage_ms}")
+    print(f"Stage columns are mean ms per frame; errors are per-class differences from "
+          f"the ground truth of {truth['total_vehicles']} vehicles")
+
+    report = {'video': truth, 'configs': rows}
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"Report written to {args.report}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = check_regressions(report, baseline, args.max_slowdown, args.max_rss_growth)
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        if failures:
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+
+def count_instance(video, line_position, model_path, threads, ready):
+    """
+    One of several counters running at once for the scaling benchmark
+
+    Sets up threads and CPUs, loads and warms up the model, then waits on
+    the ready barrier so every instance starts counting together.
+
+    Returns:
+        dict: Frames counted and the wall-clock start and end of counting
+    """
+    vc = load_vehicle_counter()
+    vc.configure_threads(**threads)
+    model = vc.load_model(model_path) if model_path else PixelTracker()
+    counter = vc.VehicleCounter(model_path=model_path or 'yolov8n.pt', model=model)
+    cap = cv2.VideoCapture(video)
+    shape = (int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+    cap.release()
+    counter.warm_up(shape)
+    counter.warmup_runs = 0
+
+    ready.wait()
+    start = time.time()
+    # Keep process_video's progress and stage reports out of the benchmark's output
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = counter.process_video(video, display_video=False, line_position=line_position)
+    return {'frames': result['frames'], 'start': start, 'end': time.time()}
+
+
+def run_scaling(args):
+    """Total fps of 1..N counters running at once, with default and pinned threads"""
+    vc = load_vehicle_counter()
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+        else list(range(os.cpu_count()))
+    modes = args.modes.split(',')
+    with tempfile.TemporaryDirectory(prefix='vehicle-bench-') as work_dir:
+        video = args.video
+        if video is None:
+            video = os.path.join(work_dir, 'traffic.mp4')
+            print(f"Generating {args.seconds:g}s of {args.width}x{args.height} synthetic traffic")
+            make_traffic_video(video, args.seconds, args.fps, args.width, args.height,
+                               args.vehicles_per_minute, args.line_position, args.seed)
+
+        print(f"{len(cpus)} CPUs; detector: {args.model or 'PixelTracker stand-in'}")
+        rows = []
+        for mode in modes:
+            single = None
+            for instances in range(1, args.max_instances + 1):
+                if mode == 'pinned':
+                    # Each instance gets its own CPUs and a thread per CPU
+                    size = max(1, len(cpus) // instances)
+                    threads = [{'intra_op': size, 'inter_op': 1, 'opencv': size, 'cpus': cpu_set}
+                               for cpu_set in vc.cpu_slices(instances, size, cpus)]
+                else:
+                    threads = [{}] * instances
+                context = multiprocessing.get_context('spawn')
+                ready = context.Barrier(instances)
+                results = run_concurrently([(count_instance, (video, args.line_position,
+                                                              args.model, thread_settings, ready))
+                                            for thread_settings in threads])
+                frames = sum(result['frames'] for result in results)
+                wall = max(result['end'] for result in results) - min(result['start']
+                                                                      for result in results)
+                total_fps = frames / max(wall, 1e-9)
+                single = single or total_fps
+                rows.append((mode, instances, total_fps, single))
+                print(f"{mode} x{instances}: {total_fps:.1f} fps total")
+
+    print("-" * 60)
+    print(f"{'threads':<9} {'instances':>9} {'total fps':>10} {'per instance':>13} {'vs x1':>7}")
+    for mode, instances, total_fps, single in rows:
+        print(f"{mode:<9} {instances:>9} {total_fps:>10.1f} {total_fps / instances:>13.1f} "
+              f"{total_fps / single:>6.2f}x")
+    print("Total fps is all frames counted over the wall time from the first start to the "
+          "last finish")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vehicle counter benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    soak = subparsers.add_parser('soak', help='Check track state memory stays flat over long runs')
+    soak.add_argument('--hours', type=float, default=6,
+                      help='Hours of 30 fps video to simulate (default: 6)')
+    soak.add_argument('--fps', type=int, default=30)
+    soak.add_argument('--vehicles-per-minute', type=float, default=60)
+    soak.add_argument('--max-track-age', type=int, default=300)
+    soak.add_argument('--batch-size', type=int, default=32)
+    soak.add_argument('--samples', type=int, default=20,
+                      help='Memory samples to take over the run (default: 20)')
+    soak.add_argument('--max-growth', type=float, default=0.05,
+                      help='Allowed RSS growth after warm-up, as a fraction (default: 0.05)')
+    soak.set_defaults(run=run_soak)
+
+    detect_every = subparsers.add_parser(
+        'detect-every', help='Compare per-frame tracking with detecting every N frames')
+    detect_every.add_argument('video', help='Video to count')
+    detect_every.add_argument('--model', default='yolov8n.pt')
+    detect_every.add_argument('--confidence', type=float, default=0.3)
+    detect_every.add_argument('--max-interval', type=int, default=5,
+                              help='Largest detection interval N to try (default: 5)')
+    detect_every.add_argument('--batch-size', type=int, default=1)
+    detect_every.add_argument('--line-position', type=float, default=0.5)
+    detect_every.add_argument('--ground-truth', type=int,
+                              help='Known vehicle total to score against instead of model.track')
+    detect_every.set_defaults(run=run_detect_every)
+
+    backends = subparsers.add_parser(
+        'backends', help='Compare fps and counts of inference backends on one clip')
+    backends.add_argument('video', help='Video to count')
+    backends.add_argument('--model', default='yolov8n.pt')
+    backends.add_argument('--backends', default='torch,onnx,openvino,openvino-int8',
+                          help='Comma-separated backends, with -int8 for the quantized '
+                               'variant; the first is the reference (default: %(default)s)')
+    backends.add_argument('--confidence', type=float, default=0.3)
+    backends.add_argument('--batch-size', type=int, default=1)
+    backends.add_argument('--line-position', type=float, default=0.5)
+    backends.add_argument('--ground-truth', type=int,
+                          help='Known vehicle total to score against instead of the first backend')
+    backends.set_defaults(run=run_backends)
+
+    synthesize = subparsers.add_parser(
+        'synthesize', help='Write a synthetic traffic video with ground truth crossings')
+    synthesize.add_argument('output', help='Video file to write (.mp4)')
+    suite = subparsers.add_parser(
+        'suite', help='Compare fps, stage times, peak memory and accuracy of counter '
+                      'configurations on synthetic traffic')
+    suite.add_argument('--video',
+                       help='Synthetic video from "synthesize" to use (default: generate one)')
+    suite.add_argument('--configs',
+                       help='Comma-separated configurations to run (default: all of '
+                            + ', '.join(SUITE_CONFIGS) + ')')
+    suite.add_argument('--report', help='Save the results as JSON, e.g. as a future baseline')
+    suite.add_argument('--baseline', help='Fail if results regressed from this saved report')
+    suite.add_argument('--max-slowdown', type=float, default=0.2,
+                       help='Allowed fps drop from the baseline, as a fraction (default: 0.2)')
+    suite.add_argument('--max-rss-growth', type=float, default=0.2,
+                       help='Allowed peak RSS growth from the baseline, as a fraction '
+                            '(default: 0.2)')
+    scaling = subparsers.add_parser(
+        'scaling', help='Total fps of several counters on one host, with default '
+                        'and pinned threads')
+    scaling.add_argument('--video',
+                         help='Video to count in every instance (default: generate one)')
+    scaling.add_argument('--model',
+                         help='YOLO weights to run (default: the PixelTracker stand-in, which '
+                              'exercises OpenCV threads but not torch)')
+    scaling.add_argument('--max-instances', type=int, default=4,
+                         help='Run 1 to this many instances at once (default: 4)')
+    scaling.add_argument('--modes', default='default,pinned',
+                         help='Thread setups to compare: default leaves the libraries to size '
+                              'their pools, pinned splits the CPUs between instances '
+                              '(default: %(default)s)')
+    for command in (synthesize, suite, scaling):
+        command.add_argument('--seconds', type=float, default=60)
+        command.add_argument('--fps', type=int, default=30)
+        command.add_argument('--width', type=int, default=1280)
+        command.add_argument('--height', type=int, default=720)
+        command.add_argument('--vehicles-per-minute', type=float, default=40)
+        command.add_argument('--line-position', type=float, default=0.5)
+        command.add_argument('--seed', type=int, default=0)
+    synthesize.set_defaults(run=run_synthesize)
+    suite.set_defaults(run=run_suite)
+    scaling.set_defaults(run=run_scaling)
+
+    args = parser.parse_args()
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,312 +1,4113 @@
+import time
+# Startup time is reported from here
+_STARTED_AT = time.perf_counter()
 import cv2
 import numpy as np
-from ultralytics import YOLO
 import argparse
-from collections import defaultdict
-import time
+from collections import defaultdict, deque
+import contextlib
+import csv
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import pickle
+import queue
+import threading
 import sys
+from collections import namedtuple
+
+# Per-frame result of detect_and_count_batch: boxes to draw, counting events
+# and the (total, per-type) counts right after the frame was counted
+CountedFrame = namedtuple('CountedFrame', ['detections', 'events', 'stats'])
+
+# Tracker output for one frame as NumPy arrays: (N, 4) center-x/y/w/h boxes,
+# track IDs, class IDs and confidences
+TrackedBoxes = namedtuple('TrackedBoxes', ['xywh', 'track_ids', 'class_ids', 'confidences'])
+
+# Inference backends load_model() can run the detector on
+BACKENDS = ('torch', 'onnx', 'openvino')
+
+def YOLO(*args, **kwargs):
+    """
+    ultralytics.YOLO, imported on first use
+    
+    Importing ultralytics pulls in torch and takes seconds, which --help,
+    argument errors and missing input files shouldn't have to wait for.
+    """
+    from ultralytics import YOLO
+    if _torch_threads:
+        _apply_torch_threads()
+    return YOLO(*args, **kwargs)
+
+# Torch thread counts from configure_threads(), applied once torch is imported
+_torch_threads = {}
+
+def configure_threads(intra_op=None, inter_op=None, opencv=None, cpus=None):
+    """
+    Limit the threads and CPUs this process uses
+    
+    By default every counter process sizes its torch and OpenCV thread pools
+    for the whole machine (Ultralytics sets torch to up to 8 threads on each
+    predictor setup), so several counters on one host spend their time
+    pre-empting each other. Call this before the model is loaded: torch
+    picks up OMP_NUM_THREADS when it is imported and its inter-op pool can
+    only be sized before it is first used.
+    
+    Args:
+        intra_op (int): Threads torch, OpenMP and MKL use inside one operator
+        inter_op (int): Threads torch runs independent operators on
+        opencv (int): OpenCV worker threads (0 runs OpenCV single-threaded)
+        cpus (list): CPU numbers to pin this process to; processes it starts
+                     inherit the pinning (Linux only)
+    """
+    if cpus:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        else:
+            print("CPU pinning needs Linux; running unpinned")
+    if intra_op:
+        for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+            os.environ[name] = str(intra_op)
+    if opencv is not None:
+        cv2.setNumThreads(opencv)
+    
+    if intra_op:
+        _torch_threads['intra_op'] = intra_op
+    if inter_op:
+        _torch_threads['inter_op'] = inter_op
+    if 'torch' in sys.modules:
+        _apply_torch_threads()
+
+def _apply_torch_threads():
+    """Set the torch thread counts asked for in configure_threads()"""
+    import torch
+    intra_op = _torch_threads.get('intra_op')
+    if intra_op:
+        torch.set_num_threads(intra_op)
+        # Ultralytics resets torch to its own NUM_THREADS whenever it sets up a predictor
+        from ultralytics.utils import torch_utils
+        torch_utils.NUM_THREADS = intra_op
+    
+    inter_op = _torch_threads.pop('inter_op', None)
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError:
+            # Only allowed before torch first runs operators in parallel
+            print(f"torch inter-op threads already started; not resizing to {inter_op}")
+
+def parse_cpu_list(text):
+    """CPU numbers from a list like "0-3,8,10-11" """
+    cpus = []
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+def cpu_slices(count, size, cpus=None):
+    """
+    Split CPUs into count sets of size CPUs each, for pinning workers
+    
+    Args:
+        count (int): Number of sets
+        size (int): CPUs per set
+        cpus (list): CPUs to split (default: those this process may run on)
+        
+    Returns:
+        list: count lists of CPU numbers; they only overlap when there are
+              fewer than count * size CPUs, wrapping round
+    """
+    if cpus is None:
+        cpus = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count())
+    cpus = sorted(cpus)
+    return [[cpus[(i * size + j) % len(cpus)] for j in range(size)] for i in range(count)]
+
+def exported_model_path(model_path, backend='torch', int8=False):
+    """
+    Where the export of model_path for a backend lives, next to the weights
+    
+    Args:
+        model_path (str): Path to PyTorch YOLO weights (.pt)
+        backend (str): One of BACKENDS
+        int8 (bool): INT8-quantized variant
+        
+    Returns:
+        str: Path of the exported model file or directory
+    """
+    stem = os.path.splitext(model_path)[0] + ('_int8' if int8 else '')
+    if backend == 'onnx':
+        return stem + '.onnx'
+    if backend == 'openvino':
+        return stem + '_openvino_model'
+    raise ValueError(f"No export for backend: {backend}")
+
+def export_model(model_path, backend='torch', int8=False, calibration_data='coco8.yaml'):
+    """
+    Export model_path for a backend unless an up-to-date export already exists
+    
+    OpenVINO INT8 models are quantized by the Ultralytics exporter, which
+    calibrates on calibration_data. ONNX Runtime has no INT8 export there,
+    so ONNX INT8 models are the FP32 export with dynamically quantized
+    weights, which needs the onnxruntime package.
+    
+    Args:
+        model_path (str): Path to PyTorch YOLO weights, or an already exported model
+        backend (str): One of BACKENDS
+        int8 (bool): Export an INT8-quantized variant
+        calibration_data (str): Dataset YAML used to calibrate OpenVINO INT8
+        
+    Returns:
+        str: Path to load with YOLO()
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    if backend == 'torch' or not model_path.endswith('.pt'):
+        if int8 and backend == 'torch':
+            raise ValueError("INT8 needs the onnx or openvino backend")
+        return model_path
+    
+    path = exported_model_path(model_path, backend, int8)
+    if os.path.exists(path) and (not os.path.exists(model_path) or
+                                 os.path.getmtime(path) >= os.path.getmtime(model_path)):
+        return path
+    
+    print(f"Exporting {model_path} for {backend}{' INT8' if int8 else ''}: {path}")
+    if backend == 'openvino':
+        exported = YOLO(model_path).export(format='openvino', dynamic=True, int8=int8,
+                                           data=calibration_data if int8 else None)
+    else:
+        exported = YOLO(model_path).export(format='onnx', dynamic=True)
+        if int8:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(exported, path + '.tmp', weight_type=QuantType.QUInt8)
+            os.replace(path + '.tmp', path)
+            return path
+    
+    if os.path.abspath(exported) != os.path.abspath(path):
+        os.replace(exported, path)
+    return path
+
+def load_model(model_path, backend='torch', int8=False):
+    """
+    Load a YOLO model on the given inference backend
+    
+    Args:
+        model_path (str): Path to PyTorch YOLO weights, or an already exported model
+        backend (str): One of BACKENDS; exported on first use
+        int8 (bool): Use the INT8-quantized variant
+        
+    Returns:
+        YOLO: Model with track() and predict() on the chosen runtime
+    """
+    path = export_model(model_path, backend, int8)
+    if path.endswith('.pt'):
+        return YOLO(path)
+    # Exported models don't record their task, so say it's detection
+    return YOLO(path, task='detect')
+
+def empty_tracked_boxes():
+    """TrackedBoxes for a frame with nothing tracked"""
+    return TrackedBoxes(np.empty((0, 4), dtype=np.float32), np.empty(0, dtype=np.int32),
+                        np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+
+def _tracked_boxes_from_result(result):
+    """Convert one Ultralytics tracking result to TrackedBoxes"""
+    if result.boxes is None or result.boxes.id is None:
+        return empty_tracked_boxes()
+    
+    # Get detection boxes, track IDs, and classes
+    return TrackedBoxes(result.boxes.xywh.cpu().numpy(),
+                        result.boxes.id.int().cpu().numpy(),
+                        result.boxes.cls.int().cpu().numpy(),
+                        result.boxes.conf.cpu().numpy())
+
+def _detections_from_result(result):
+    """Convert one Ultralytics detection result to (xywh, class_ids, confidences)"""
+    if result.boxes is None:
+        empty = empty_tracked_boxes()
+        return empty.xywh, empty.class_ids, empty.confidences
+    return (result.boxes.xywh.cpu().numpy(),
+            result.boxes.cls.int().cpu().numpy(),
+            result.boxes.conf.cpu().numpy())
+
+def box_iou(boxes_a, boxes_b, smaller=False):
+    """
+    Pairwise IoU of two sets of center-format boxes
+    
+    Args:
+        boxes_a (np.ndarray): (n, 4) boxes as center x, center y, width, height
+        boxes_b (np.ndarray): (m, 4) boxes in the same format
+        smaller (bool): Divide the intersection by the smaller box's area
+                        instead of the union
+        
+    Returns:
+        np.ndarray: (n, m) IoU of every pair
+    """
+    a = np.concatenate([boxes_a[:, :2] - boxes_a[:, 2:] / 2, boxes_a[:, :2] + boxes_a[:, 2:] / 2], 1)
+    b = np.concatenate([boxes_b[:, :2] - boxes_b[:, 2:] / 2, boxes_b[:, :2] + boxes_b[:, 2:] / 2], 1)
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area_a = boxes_a[:, 2] * boxes_a[:, 3]
+    area_b = boxes_b[:, 2] * boxes_b[:, 3]
+    if smaller:
+        return inter / np.maximum(np.minimum(area_a[:, None], area_b[None, :]), 1e-9)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+def non_max_suppression(xywh, class_ids, confidences, threshold=0.6, smaller=True):
+    """
+    Greedy per-class non-maximum suppression
+    
+    Args:
+        xywh (np.ndarray): (n, 4) boxes as center x, center y, width, height
+        class_ids (np.ndarray): (n,) class ID per box
+        confidences (np.ndarray): (n,) confidence per box
+        threshold (float): Overlap above which the less confident box is dropped
+        smaller (bool): Measure overlap against the smaller box, so a vehicle cut
+                        in two by a tile edge is merged into its whole box
+        
+    Returns:
+        np.ndarray: Indices of the boxes kept, most confident first
+    """
+    # Most confident first; on ties the larger box wins over a tile-cut part of it
+    order = np.lexsort((-xywh[:, 2] * xywh[:, 3], -confidences))
+    overlap = box_iou(xywh[order], xywh[order], smaller)
+    suppress = (overlap > threshold) & (class_ids[order, None] == class_ids[None, order])
+    keep = np.ones(len(order), dtype=bool)
+    for i in range(len(order)):
+        if keep[i]:
+            keep[i + 1:] &= ~suppress[i, i + 1:]
+    return order[keep]
+
+def _greedy_pairs(scores, allowed):
+    """
+    Match rows to columns greedily, best score first
+    
+    Args:
+        scores (np.ndarray): (n, m) match scores, higher is better
+        allowed (np.ndarray): (n, m) boolean mask of pairs that may match
+        
+    Returns:
+        tuple: Matched row indices and column indices as arrays
+    """
+    rows, cols = np.nonzero(allowed)
+    order = np.argsort(-scores[rows, cols], kind='stable')
+    used_rows, used_cols = set(), set()
+    matched_rows, matched_cols = [], []
+    for row, col in zip(rows[order], cols[order]):
+        if row in used_rows or col in used_cols:
+            continue
+        used_rows.add(row)
+        used_cols.add(col)
+        matched_rows.append(row)
+        matched_cols.append(col)
+    return np.array(matched_rows, dtype=np.intp), np.array(matched_cols, dtype=np.intp)
+
+class BoxTracker:
+    """
+    Lightweight NumPy tracker for running the detector only every few frames
+    
+    Like SORT without the Kalman filter: each track moves at a constant
+    velocity measured between its last two detections, detections are
+    matched to the predicted boxes greedily by IoU, and boxes that drifted
+    too far from their prediction for any overlap are matched by center
+    distance instead. On frames between detections every live track
+    is moved along its velocity, so counting sees a continuous trail.
+    """
+    
+    def __init__(self, detect_interval=1, iou_threshold=0.3, max_speed=0.5,
+                 max_misses=2, smoothing=0.5):
+        """
+        Args:
+            detect_interval (int): Run the detector on every Nth frame
+            iou_threshold (float): Minimum IoU to match a detection to a track
+            max_speed (float): Box sizes per frame a track can have moved away from
+                               its prediction, for matches that fail the IoU test
+            max_misses (int): Detection frames a track can go unmatched before it is dropped
+            smoothing (float): Weight of the previous velocity when a new one is measured
+        """
+        self.detect_interval = detect_interval
+        self.iou_threshold = iou_threshold
+        self.max_speed = max_speed
+        self.max_misses = max_misses
+        self.smoothing = smoothing
+        
+        self.frames_seen = 0
+        self.next_id = 1
+        
+        # Per track: current box, velocity (px/frame), center at the last
+        # detection and frames since then, misses and detections matched
+        self.boxes = np.empty((0, 4), dtype=np.float32)
+        self.velocity = np.empty((0, 2), dtype=np.float32)
+        self.anchor = np.empty((0, 2), dtype=np.float32)
+        self.since_detection = np.empty(0, dtype=np.int32)
+        self.misses = np.empty(0, dtype=np.int32)
+        self.hits = np.empty(0, dtype=np.int32)
+        self.track_ids = np.empty(0, dtype=np.int32)
+        self.class_ids = np.empty(0, dtype=np.int32)
+        self.confidences = np.empty(0, dtype=np.float32)
+    
+    def settings(self):
+        """Parameters that change the tracker output"""
+        return {
+            'detect_interval': self.detect_interval, 'iou_threshold': self.iou_threshold,
+            'max_speed': self.max_speed, 'max_misses': self.max_misses,
+            'smoothing': self.smoothing,
+        }
+    
+    def detection_due(self, offset=0):
+        """Whether the frame offset frames after the next one should run the detector"""
+        return (self.frames_seen + offset) % self.detect_interval == 0
+    
+    def predict(self):
+        """
+        Advance one frame without detections
+        
+        Returns:
+            TrackedBoxes: Predicted boxes of tracks matched at the last detection
+        """
+        self._advance()
+        return self._output(self.misses == 0)
+    
+    def update(self, xywh, class_ids, confidences):
+        """
+        Advance one frame and match its detections
+        
+        Args:
+            xywh (np.ndarray): (n, 4) detected boxes as center x, center y, width, height
+            class_ids (np.ndarray): (n,) class ID per detection
+            confidences (np.ndarray): (n,) confidence per detection
+            
+        Returns:
+            TrackedBoxes: Matched and newly started tracks, at their detected boxes
+        """
+        self._advance()
+        track_index, det_index = self._match(xywh, class_ids)
+        
+        # Matched tracks: measure velocity since their last detection
+        centers = xywh[det_index, :2]
+        measured = (centers - self.anchor[track_index]) / self.since_detection[track_index, None]
+        seen_before = (self.hits[track_index] > 1)[:, None]
+        blended = self.smoothing * self.velocity[track_index] + (1 - self.smoothing) * measured
+        self.velocity[track_index] = np.where(seen_before, blended, measured)
+        self.boxes[track_index] = xywh[det_index]
+        self.anchor[track_index] = centers
+        self.since_detection[track_index] = 0
+        self.hits[track_index] += 1
+        self.class_ids[track_index] = class_ids[det_index]
+        self.confidences[track_index] = confidences[det_index]
+        
+        matched = np.zeros(len(self.track_ids), dtype=bool)
+        matched[track_index] = True
+        self.misses[~matched] += 1
+        self.misses[matched] = 0
+        
+        # Unmatched detections start new tracks
+        new = np.ones(len(xywh), dtype=bool)
+        new[det_index] = False
+        count = int(new.sum())
+        self.boxes = np.concatenate([self.boxes, xywh[new]]).astype(np.float32)
+        self.velocity = np.concatenate([self.velocity, np.zeros((count, 2), dtype=np.float32)])
+        self.anchor = np.concatenate([self.anchor, xywh[new, :2]]).astype(np.float32)
+        self.since_detection = np.concatenate([self.since_detection, np.zeros(count, dtype=np.int32)])
+        self.misses = np.concatenate([self.misses, np.zeros(count, dtype=np.int32)])
+        self.hits = np.concatenate([self.hits, np.ones(count, dtype=np.int32)])
+        self.track_ids = np.concatenate([self.track_ids,
+                                         np.arange(self.next_id, self.next_id + count, dtype=np.int32)])
+        self.class_ids = np.concatenate([self.class_ids, class_ids[new]]).astype(np.int32)
+        self.confidences = np.concatenate([self.confidences, confidences[new]]).astype(np.float32)
+        self.next_id += count
+        
+        tracked = self._output(self.misses == 0)
+        self._keep(self.misses <= self.max_misses)
+        return tracked
+    
+    def _advance(self):
+        """Move every track one frame along its velocity"""
+        self.frames_seen += 1
+        self.since_detection += 1
+        self.boxes[:, :2] = self.anchor + self.velocity * self.since_detection[:, None]
+    
+    def _match(self, xywh, class_ids):
+        """Match detections to tracks, by IoU first and then by center distance"""
+        if len(self.track_ids) == 0 or len(xywh) == 0:
+            empty = np.empty(0, dtype=np.intp)
+            return empty, empty
+        
+        iou = box_iou(self.boxes, xywh)
+        track_index, det_index = _greedy_pairs(iou, iou >= self.iou_threshold)
+        
+        # Fast or newly started tracks can miss their predicted box entirely;
+        # fall back to the nearest detection of the same class
+        free_tracks = np.setdiff1d(np.arange(len(self.track_ids)), track_index)
+        free_dets = np.setdiff1d(np.arange(len(xywh)), det_index)
+        if len(free_tracks) and len(free_dets):
+            offsets = self.boxes[free_tracks, None, :2] - xywh[None, free_dets, :2]
+            scale = np.maximum(self.boxes[free_tracks, 2:].max(axis=1), 1)
+            distance = np.hypot(offsets[..., 0], offsets[..., 1]) / scale[:, None]
+            # Tracks without a measured velocity yet may be anywhere along their path
+            reach = np.where(self.hits[free_tracks] > 1, 1.0,
+                             np.maximum(self.max_speed * self.since_detection[free_tracks], 1))
+            allowed = ((distance <= reach[:, None]) &
+                       (self.class_ids[free_tracks, None] == class_ids[None, free_dets]))
+            rows, cols = _greedy_pairs(-distance, allowed)
+            track_index = np.concatenate([track_index, free_tracks[rows]])
+            det_index = np.concatenate([det_index, free_dets[cols]])
+        return track_index, det_index
+    
+    def _output(self, mask):
+        return TrackedBoxes(self.boxes[mask].copy(), self.track_ids[mask].copy(),
+                            self.class_ids[mask].copy(), self.confidences[mask].copy())
+    
+    def _keep(self, mask):
+        for name in ('boxes', 'velocity', 'anchor', 'since_detection', 'misses', 'hits',
+                     'track_ids', 'class_ids', 'confidences'):
+            setattr(self, name, getattr(self, name)[mask])
+
+class InferenceRegion:
+    """
+    Part of the frame the detector is run on
+    
+    The frame is cropped to the bounding box of the ROI polygons, pixels
+    outside the polygons are blacked out, and detections whose centers fall
+    outside them are dropped. With a tile_size the crop is further split into
+    overlapping tiles that are detected in one batch and merged with
+    non-maximum suppression, so small vehicles in high-resolution frames
+    are not lost to downscaling. Boxes are always returned in full-frame
+    pixels.
+    """
+    
+    def __init__(self, polygons=None, tile_size=None, tile_overlap=0.2, nms_threshold=0.6):
+        """
+        Args:
+            polygons (list): ROI polygons, each a list of (x, y) points as
+                             fractions of the frame (default: whole frame)
+            tile_size (int): Side of the square tiles in pixels (default: no tiling)
+            tile_overlap (float): Fraction of a tile shared with its neighbour
+            nms_threshold (float): Overlap at which boxes from different tiles are merged
+        """
+        self.polygons = [[tuple(point) for point in polygon] for polygon in polygons or []]
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.nms_threshold = nms_threshold
+        
+        # Windows and polygon mask depend only on the frame size
+        self._shape = None
+        self._windows = None
+        self._mask = None
+    
+    @property
+    def tiled(self):
+        return self.tile_size is not None
+    
+    def settings(self):
+        """Parameters that change the detections"""
+        return {
+            'polygons': [[list(point) for point in polygon] for polygon in self.polygons],
+            'tile_size': self.tile_size, 'tile_overlap': self.tile_overlap,
+            'nms_threshold': self.nms_threshold,
+        }
+    
+    def cut(self, frame):
+        """
+        Images to run the detector on for one frame
+        
+        Args:
+            frame (np.ndarray): Full video frame
+            
+        Returns:
+            list: (image, (x, y)) per window, with the window's top-left corner
+        """
+        self._prepare(frame.shape[:2])
+        images = []
+        for x1, y1, x2, y2 in self._windows:
+            image = frame[y1:y2, x1:x2]
+            if self._mask is not None:
+                image = cv2.bitwise_and(image, image, mask=self._mask[y1:y2, x1:x2])
+            images.append((image, (x1, y1)))
+        return images
+    
+    def to_frame(self, xywh, offset):
+        """Shift window boxes to full-frame coordinates"""
+        xywh = xywh.copy()
+        xywh[:, 0] += offset[0]
+        xywh[:, 1] += offset[1]
+        return xywh
+    
+    def inside(self, xywh):
+        """
+        Which full-frame boxes have their center inside the ROI
+        
+        Returns:
+            np.ndarray: Boolean mask over the boxes
+        """
+        if self._mask is None:
+            return np.ones(len(xywh), dtype=bool)
+        height, width = self._mask.shape
+        x = np.clip(xywh[:, 0].astype(int), 0, width - 1)
+        y = np.clip(xywh[:, 1].astype(int), 0, height - 1)
+        return self._mask[y, x] > 0
+    
+    def merge(self, detections, offsets):
+        """
+        Combine the detections of one frame's windows
+        
+        Args:
+            detections (list): (xywh, class_ids, confidences) per window
+            offsets (list): Top-left corner of each window
+            
+        Returns:
+            tuple: (xywh, class_ids, confidences) in full-frame coordinates
+        """
+        xywh = np.concatenate([self.to_frame(boxes, offset)
+                               for (boxes, _, _), offset in zip(detections, offsets)])
+        class_ids = np.concatenate([d[1] for d in detections])
+        confidences = np.concatenate([d[2] for d in detections])
+        
+        keep = self.inside(xywh)
+        xywh, class_ids, confidences = xywh[keep], class_ids[keep], confidences[keep]
+        if len(detections) > 1:
+            keep = non_max_suppression(xywh, class_ids, confidences, self.nms_threshold)
+            xywh, class_ids, confidences = xywh[keep], class_ids[keep], confidences[keep]
+        return xywh, class_ids, confidences
+    
+    def _prepare(self, shape):
+        if shape == self._shape:
+            return
+        height, width = shape
+        self._shape = shape
+        
+        if self.polygons:
+            self._mask = np.zeros((height, width), dtype=np.uint8)
+            points = [np.round(np.array(polygon) * (width, height)).astype(np.int32)
+                      for polygon in self.polygons]
+            cv2.fillPoly(self._mask, points, 255)
+            x, y, w, h = cv2.boundingRect(np.concatenate(points))
+            x1, y1 = max(x, 0), max(y, 0)
+            x2, y2 = min(x + w, width), min(y + h, height)
+        else:
+            self._mask = None
+            x1, y1, x2, y2 = 0, 0, width, height
+        
+        if not self.tiled:
+            self._windows = [(x1, y1, x2, y2)]
+            return
+        
+        # Overlapping tiles covering the crop, the last ones flush with its edges
+        step = max(1, int(self.tile_size * (1 - self.tile_overlap)))
+        xs = self._tile_starts(x1, x2, step)
+        ys = self._tile_starts(y1, y2, step)
+        self._windows = [(x, y, min(x + self.tile_size, x2), min(y + self.tile_size, y2))
+                         for y in ys for x in xs]
+    
+    def _tile_starts(self, start, end, step):
+        if end - start <= self.tile_size:
+            return [start]
+        starts = list(range(start, end - self.tile_size, step))
+        return starts + [end - self.tile_size]
+
+class MotionGate:
+    """
+    Cheap test for whether anything moved, used to skip inference on static frames
+    
+    Each frame is shrunk to a small grayscale image, cropped to the region of
+    interest and compared with a running-average background. Inference runs
+    when enough pixels differ from the background, keeps running for
+    hold_frames after motion stops so tracks can leave the frame, and runs at
+    least every max_skip frames so the tracker never goes stale.
+    """
+    
+    def __init__(self, roi=None, width=160, threshold=25, min_area=0.002,
+                 hold_frames=15, max_skip=30, learning_rate=0.05):
+        """
+        Args:
+            roi (tuple): (x1, y1, x2, y2) region to watch, as fractions of the frame
+            width (int): Width the frame is shrunk to before comparing
+            threshold (int): Gray-level difference that counts as a changed pixel
+            min_area (float): Fraction of ROI pixels that must change to count as motion
+            hold_frames (int): Frames to keep running inference after motion stops
+            max_skip (int): Most frames skipped in a row
+            learning_rate (float): How fast the background adapts to the scene
+        """
+        self.roi = tuple(roi) if roi is not None else (0.0, 0.0, 1.0, 1.0)
+        self.width = width
+        self.threshold = threshold
+        self.min_area = min_area
+        self.hold_frames = hold_frames
+        self.max_skip = max_skip
+        self.learning_rate = learning_rate
+        
+        self.frames_checked = 0
+        self.frames_skipped = 0
+        self._background = None
+        self._hold = 0
+        self._since_run = 0
+    
+    def settings(self):
+        """Parameters that decide which frames are skipped"""
+        return {
+            'roi': list(self.roi), 'width': self.width, 'threshold': self.threshold,
+            'min_area': self.min_area, 'hold_frames': self.hold_frames,
+            'max_skip': self.max_skip, 'learning_rate': self.learning_rate,
+        }
+    
+    def should_run(self, frame):
+        """
+        Check one frame, in video order
+        
+        Returns:
+            bool: True if inference should run on this frame
+        """
+        self.frames_checked += 1
+        height = max(1, frame.shape[0] * self.width // frame.shape[1])
+        small = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        x1, y1, x2, y2 = self.roi
+        gray = gray[int(y1 * height):max(int(y2 * height), int(y1 * height) + 1),
+                    int(x1 * self.width):max(int(x2 * self.width), int(x1 * self.width) + 1)]
+        gray = cv2.GaussianBlur(gray, (5, 5), 0)
+        
+        if self._background is None:
+            self._background = gray.astype(np.float32)
+            self._since_run = 0
+            return True
+        
+        diff = cv2.absdiff(gray, cv2.convertScaleAbs(self._background))
+        moving = np.count_nonzero(diff > self.threshold) >= self.min_area * diff.size
+        cv2.accumulateWeighted(gray, self._background, self.learning_rate)
+        
+        if moving:
+            self._hold = self.hold_frames
+        elif self._hold > 0:
+            self._hold -= 1
+        self._since_run += 1
+        
+        if moving or self._hold > 0 or self._since_run >= self.max_skip:
+            self._since_run = 0
+            return True
+        self.frames_skipped += 1
+        return False
+
+class AdaptiveResolution:
+    """
+    Trades inference resolution, then frames, for speed to meet a latency target
+    
+    Inference time per video frame is averaged over windows of frames. A
+    window over target_latency steps the model's input size down one notch
+    and, at the smallest size, starts skipping frames, up to max_stride. A
+    window with room to spare steps back the other way (fewer skipped
+    frames first, then a larger input size), but only when the next setting
+    is predicted to fit, assuming time grows with input pixels or with the
+    frames run. Measurements restart after every change, so each decision
+    rests on a window measured entirely at the current setting.
+    """
+    
+    def __init__(self, target_latency, sizes=(320, 416, 512, 640), max_stride=1, window=30,
+                 headroom=0.8, start_size=None):
+        """
+        Args:
+            target_latency (float): Seconds of inference time allowed per video frame
+            sizes (tuple): Model input sizes to choose from, multiples of 32
+            max_stride (int): Most frames per inference once at the smallest size
+                              (1 never skips frames)
+            window (int): Frames measured before each decision
+            headroom (float): Step up only when the next setting is predicted to
+                              use at most this fraction of the target
+            start_size (int): Input size to start at (default: the largest)
+        """
+        self.target_latency = target_latency
+        self.sizes = sorted(sizes)
+        self.max_stride = max(1, max_stride)
+        self.window = window
+        self.headroom = headroom
+        self.level = self.sizes.index(start_size) if start_size else len(self.sizes) - 1
+        self.stride = 1
+        
+        # Changes made so far: frame, measured latency, new input size and stride
+        self.changes = []
+        self.frames_seen = 0
+        self._window_seconds = 0.0
+        self._window_frames = 0
+    
+    @property
+    def imgsz(self):
+        """Model input size to run at now"""
+        return self.sizes[self.level]
+    
+    def should_run(self):
+        """Whether inference runs on the next frame under the current stride"""
+        self.frames_seen += 1
+        return (self.frames_seen - 1) % self.stride == 0
+    
+    def update(self, seconds, frames):
+        """
+        Record inference time and adjust the setting once a window is full
+        
+        Args:
+            seconds (float): Inference time spent on the frames, including
+                             frames skipped under the stride
+            frames (int): Video frames the time covers
+        """
+        self._window_seconds += seconds
+        self._window_frames += frames
+        if self._window_frames < self.window:
+            return
+        latency = self._window_seconds / self._window_frames
+        self._window_seconds = 0.0
+        self._window_frames = 0
+        
+        level, stride = self.level, self.stride
+        if latency > self.target_latency:
+            if level > 0:
+                level -= 1
+            elif stride < self.max_stride:
+                stride += 1
+        elif stride > 1:
+            if latency * stride / (stride - 1) <= self.target_latency * self.headroom:
+                stride -= 1
+        elif level < len(self.sizes) - 1:
+            growth = (self.sizes[level + 1] / self.sizes[level]) ** 2
+            if latency * growth <= self.target_latency * self.headroom:
+                level += 1
+        
+        if (level, stride) != (self.level, self.stride):
+            print(f"Adaptive resolution at frame {self.frames_seen}: inference "
+                  f"{latency * 1e3:.1f} ms/frame against {self.target_latency * 1e3:.1f} ms, "
+                  f"imgsz {self.imgsz} -> {self.sizes[level]}, stride {self.stride} -> {stride}")
+            self.level, self.stride = level, stride
+            self.changes.append({'frame': self.frames_seen, 'latency': latency,
+                                 'imgsz': self.imgsz, 'stride': stride})
+
+class TrackHistory:
+    """
+    Fixed-capacity store of recent center points and counted flags per track
+    
+    Every track gets a slot in preallocated arrays and keeps its last
+    history_length center points in a ring buffer. Tracks not seen for more
+    than max_age frames give their slot back, and if all slots are taken the
+    least recently seen track is dropped, so memory stays flat no matter how
+    long the video runs or how many track IDs the tracker hands out.
+    """
+    
+    def __init__(self, capacity=1024, history_length=30, max_age=300):
+        """
+        Args:
+            capacity (int): Maximum number of tracks kept at once
+            history_length (int): Center points kept per track
+            max_age (int): Frames a track can go unseen before it is evicted
+        """
+        self.capacity = capacity
+        self.history_length = history_length
+        self.max_age = max_age
+        
+        self.points = np.zeros((capacity, history_length, 2), dtype=np.int32)
+        self.heads = np.zeros(capacity, dtype=np.int32)  # next write position
+        self.lengths = np.zeros(capacity, dtype=np.int32)
+        self.last_seen = np.zeros(capacity, dtype=np.int64)
+        self.counted = np.zeros(capacity, dtype=bool)
+        self.track_ids = np.full(capacity, -1, dtype=np.int64)
+        
+        self._slots = {}  # track ID -> slot
+        self._free = list(range(capacity - 1, -1, -1))
+        self._next_sweep = max_age
+    
+    def __len__(self):
+        return len(self._slots)
+    
+    def __contains__(self, track_id):
+        return track_id in self._slots
+    
+    def __getitem__(self, track_id):
+        """Center points of a track, oldest first"""
+        return self.trail(self._slots[track_id])
+    
+    def update(self, track_ids, centers, frame_index):
+        """
+        Append one center point per track for the given frame
+        
+        Args:
+            track_ids (list): Track ID per box
+            centers (np.ndarray): (N, 2) integer center points
+            frame_index (int): Index of the frame the points belong to
+            
+        Returns:
+            np.ndarray: Slot of each track, for the other per-slot lookups
+        """
+        if frame_index >= self._next_sweep:
+            self.evict_stale(frame_index)
+            self._next_sweep = frame_index + self.max_age
+        
+        slots = np.empty(len(track_ids), dtype=np.intp)
+        for i, track_id in enumerate(track_ids):
+            slot = self._slots.get(track_id)
+            if slot is not None and frame_index - self.last_seen[slot] > self.max_age:
+                # Gone too long: treat it as a new track
+                self._release(track_id)
+                slot = None
+            if slot is None:
+                slot = self._allocate(track_id, frame_index)
+            else:
+                self.last_seen[slot] = frame_index
+            slots[i] = slot
+        
+        heads = self.heads[slots]
+        self.points[slots, heads] = centers
+        self.heads[slots] = (heads + 1) % self.history_length
+        self.lengths[slots] = np.minimum(self.lengths[slots] + 1, self.history_length)
+        return slots
+    
+    def first_points(self, slots):
+        """Oldest kept point of each slot"""
+        index = (self.heads[slots] - self.lengths[slots]) % self.history_length
+        return self.points[slots, index]
+    
+    def previous_points(self, slots):
+        """Second newest point of each slot, or the newest for single-point tracks"""
+        back = np.where(self.lengths[slots] > 1, 2, 1)
+        index = (self.heads[slots] - back) % self.history_length
+        return self.points[slots, index]
+    
+    def trail(self, slot):
+        """Copy of a slot's points, oldest first"""
+        length = self.lengths[slot]
+        index = (self.heads[slot] - length + np.arange(length)) % self.history_length
+        return self.points[slot, index]
+    
+    def is_counted(self, track_id):
+        slot = self._slots.get(track_id)
+        return slot is not None and bool(self.counted[slot])
+    
+    def mark_counted(self, track_id):
+        slot = self._slots.get(track_id)
+        if slot is not None:
+            self.counted[slot] = True
+    
+    def evict_stale(self, frame_index):
+        """Free the slots of tracks not seen for more than max_age frames"""
+        stale = (self.track_ids >= 0) & (frame_index - self.last_seen > self.max_age)
+        for track_id in self.track_ids[stale].tolist():
+            self._release(track_id)
+    
+    def _allocate(self, track_id, frame_index):
+        if not self._free:
+            self.evict_stale(frame_index)
+        if not self._free:
+            # Still full: drop the track that has gone unseen the longest
+            occupied = np.flatnonzero(self.track_ids >= 0)
+            oldest = occupied[np.argmin(self.last_seen[occupied])]
+            self._release(int(self.track_ids[oldest]))
+        
+        slot = self._free.pop()
+        self._slots[track_id] = slot
+        self.track_ids[slot] = track_id
+        self.heads[slot] = 0
+        self.lengths[slot] = 0
+        self.counted[slot] = False
+        self.last_seen[slot] = frame_index
+        return slot
+    
+    def _release(self, track_id):
+        slot = self._slots.pop(track_id)
+        self.track_ids[slot] = -1
+        self._free.append(slot)
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Hex SHA-256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class DetectionCache:
+    """
+    On-disk cache of per-frame tracker output for whole videos
+    
+    Entries are keyed by the video's content hash, the model weights and the
+    confidence threshold, so re-counting a video with a different counting
+    line or movement threshold replays the boxes, track IDs, classes and
+    confidences instead of running the model again. Content hashes are
+    remembered per (path, size, mtime) so unchanged videos are read once,
+    in one small file per path so processes sharing the cache directory
+    don't overwrite each other's.
+    """
+    
+    FORMAT_VERSION = 1
+    
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._hash_dir = os.path.join(cache_dir, 'content-hashes')
+        os.makedirs(self._hash_dir, exist_ok=True)
+    
+    def key(self, video_path, model_path, confidence_threshold, options=None):
+        """
+        Cache key for tracking a video with a model and confidence threshold
+        
+        Args:
+            video_path (str): Path to the video file
+            model_path (str): Path or name of the model weights
+            confidence_threshold (float): Confidence threshold passed to the tracker
+            options (dict): Other settings that change the tracker output
+            
+        Returns:
+            str: Hex key naming the cache entry
+        """
+        model = self._content_hash(model_path) if os.path.isfile(model_path) else model_path
+        parts = {
+            'version': self.FORMAT_VERSION,
+            'video': self._content_hash(video_path),
+            'model': model,
+            'confidence': confidence_threshold,
+        }
+        if options:
+            parts['options'] = options
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+    
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+    
+    def load(self, key):
+        """Return a CachedTracks for the key, or None on a cache miss"""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        return CachedTracks(path)
+    
+    def _content_hash(self, path):
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        abspath = os.path.abspath(path)
+        entry_path = os.path.join(self._hash_dir,
+                                  hashlib.sha256(abspath.encode()).hexdigest() + '.json')
+        if os.path.exists(entry_path):
+            with open(entry_path) as f:
+                entry = json.load(f)
+            if entry['path'] == abspath and entry['stamp'] == stamp:
+                return entry['digest']
+        
+        digest = file_sha256(path)
+        _atomic_write_text(entry_path, json.dumps({'path': abspath, 'stamp': stamp,
+                                                   'digest': digest}))
+        return digest
+
+class CachedTracks:
+    """
+    Tracker output loaded from the detection cache
+    
+    Hands out one frame's TrackedBoxes at a time through next_frame(), and
+    also stands in for cv2.VideoCapture (isOpened/get/read/release) so a
+    counting-only run can go through the cached frames without decoding the
+    video; read() then returns None for the frame itself.
+    """
+    
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.offsets = data['offsets']
+            self.xywh = data['xywh']
+            self.track_ids = data['track_ids']
+            self.class_ids = data['class_ids']
+            self.confidences = data['confidences']
+            self.fps, self.width, self.height = data['video'].tolist()
+        self.frame_count = len(self.offsets) - 1
+        self.position = 0
+        self._read_position = 0
+    
+    def next_frame(self):
+        """Tracker output for the next frame, in frame order"""
+        if self.position >= self.frame_count:
+            return empty_tracked_boxes()
+        start, end = self.offsets[self.position], self.offsets[self.position + 1]
+        self.position += 1
+        return TrackedBoxes(self.xywh[start:end], self.track_ids[start:end],
+                            self.class_ids[start:end], self.confidences[start:end])
+    
+    def isOpened(self):
+        return True
+    
+    def get(self, prop):
+        return {
+            cv2.CAP_PROP_FPS: self.fps,
+            cv2.CAP_PROP_FRAME_WIDTH: self.width,
+            cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+            cv2.CAP_PROP_FRAME_COUNT: self.frame_count,
+        }.get(prop, 0)
+    
+    def read(self):
+        if self._read_position >= self.frame_count:
+            return False, None
+        self._read_position += 1
+        return True, None
+    
+    def release(self):
+        pass
+
+class DetectionCacheWriter:
+    """Collects per-frame tracker output and saves it as a cache entry"""
+    
+    def __init__(self, path, fps, width, height):
+        self.path = path
+        self.video = np.array([fps, width, height])
+        self._frames = []
+    
+    def add_frame(self, tracked):
+        # One array per frame keeps the per-object overhead low on long videos
+        self._frames.append(np.column_stack([tracked.xywh, tracked.track_ids,
+                                             tracked.class_ids, tracked.confidences]))
+    
+    def save(self):
+        rows = np.concatenate(self._frames) if self._frames else np.empty((0, 7))
+        offsets = np.zeros(len(self._frames) + 1, dtype=np.int64)
+        np.cumsum([len(frame) for frame in self._frames], out=offsets[1:])
+        
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, offsets=offsets, video=self.video,
+                                xywh=rows[:, :4].astype(np.float32),
+                                track_ids=rows[:, 4].astype(np.int32),
+                                class_ids=rows[:, 5].astype(np.int32),
+                                confidences=rows[:, 6].astype(np.float32))
+        os.replace(tmp_path, self.path)
+
+# Moves of tracks between consecutive kept observations that pass the
+# movement threshold, i.e. the moves on which a line crossing would count.
+# Steps of a track are contiguous and in frame order.
+TrackSteps = namedtuple('TrackSteps', ['prev_points', 'points', 'track_index',
+                                       'class_ids', 'frames', 'track_count'])
+
+class CountingLine:
+    """
+    A counting line segment with an optional direction filter
+    
+    A move counts as crossing when it goes from one side of the line to the
+    other within the segment's extent. 'positive' means crossing towards the
+    side the line's normal points to: for a left-to-right horizontal line
+    that is top to bottom (the 'down' direction of the live counter).
+    """
+    
+    DIRECTIONS = ('both', 'positive', 'negative')
+    
+    def __init__(self, start, end, direction='both', name=None, bounded=True):
+        """
+        Args:
+            start (tuple): (x, y) of one end of the line
+            end (tuple): (x, y) of the other end
+            direction (str): 'both', 'positive' or 'negative'
+            name (str): Label for results (defaults to the coordinates)
+            bounded (bool): Only count moves passing between start and end;
+                            otherwise the line extends past both ends
+        """
+        if direction not in self.DIRECTIONS:
+            raise ValueError(f"direction must be one of {self.DIRECTIONS}, got {direction!r}")
+        self.start = tuple(start)
+        self.end = tuple(end)
+        self.direction = direction
+        self.name = name or f"{self.start}-{self.end}"
+        self.bounded = bounded
+    
+    @classmethod
+    def horizontal(cls, y, frame_width, direction='both', name=None):
+        """Horizontal line at pixel row y, unbounded like the live counting line"""
+        return cls((0, y), (frame_width, y), direction, name or f"y={y}", bounded=False)
+
+def count_line_crossings(steps, lines, vehicle_classes, chunk_elements=1 << 22):
+    """
+    Count vehicles for many counting lines in one vectorized pass
+    
+    Crossing tests for every (line, step) pair are computed as arrays, and
+    each track is counted at most once per line, on its first matching
+    crossing, with the class it had at that moment. For a horizontal line
+    this gives the same counts as running the live counter with that line.
+    
+    Args:
+        steps (TrackSteps): Track moves, e.g. from VehicleCounter.track_steps
+        lines (list): CountingLine objects
+        vehicle_classes (dict): Class ID -> vehicle type name
+        chunk_elements (int): Rough cap on (line, step) pairs tested at once
+        
+    Returns:
+        list: Per line, a dict with the line name, total and per-type counts
+    """
+    class_ids = sorted(vehicle_classes)
+    class_column = np.searchsorted(class_ids, steps.class_ids)
+    counts = np.zeros((len(lines), len(class_ids)), dtype=np.int64)
+    
+    if len(lines) and len(steps.track_index):
+        start = np.array([line.start for line in lines], dtype=np.float64)[:, :, None]
+        end = np.array([line.end for line in lines], dtype=np.float64)[:, :, None]
+        want_positive = np.array([line.direction != 'negative' for line in lines])[:, None]
+        want_negative = np.array([line.direction != 'positive' for line in lines])[:, None]
+        unbounded = np.array([not line.bounded for line in lines])[:, None]
+        d = end - start
+        
+        # Work through the steps in chunks so the (lines, steps) arrays stay small
+        chunk_size = max(1, chunk_elements // len(lines))
+        hit_lines = []
+        hit_steps = []
+        for chunk_start in range(0, len(steps.track_index), chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            prev = steps.prev_points[chunk].T.astype(np.float64)[None]
+            curr = steps.points[chunk].T.astype(np.float64)[None]
+            
+            # Side of each line the move starts and ends on (sign of the cross product)
+            side_prev = d[:, 0] * (prev[:, 1] - start[:, 1]) - d[:, 1] * (prev[:, 0] - start[:, 0])
+            side_curr = d[:, 0] * (curr[:, 1] - start[:, 1]) - d[:, 1] * (curr[:, 0] - start[:, 0])
+            positive = (side_prev < 0) & (side_curr >= 0) & want_positive
+            negative = (side_prev > 0) & (side_curr <= 0) & want_negative
+            
+            # The move must pass between the line's end points, if it is bounded
+            move = curr - prev
+            at_start = move[:, 0] * (start[:, 1] - prev[:, 1]) - move[:, 1] * (start[:, 0] - prev[:, 0])
+            at_end = move[:, 0] * (end[:, 1] - prev[:, 1]) - move[:, 1] * (end[:, 0] - prev[:, 0])
+            hits = (positive | negative) & ((at_start * at_end <= 0) | unbounded)
+            
+            line_index, step_index = np.nonzero(hits)
+            hit_lines.append(line_index)
+            hit_steps.append(step_index + chunk_start)
+        
+        # First crossing of each track per line: hits are in step order per line,
+        # and steps are in track then frame order
+        line_index = np.concatenate(hit_lines)
+        step_index = np.concatenate(hit_steps)
+        key = line_index * steps.track_count + steps.track_index[step_index]
+        _, first = np.unique(key, return_index=True)
+        np.add.at(counts, (line_index[first], class_column[step_index[first]]), 1)
+    
+    results = []
+    for line, line_counts in zip(lines, counts):
+        vehicle_count = {vehicle_classes[class_id]: int(count)
+                         for class_id, count in zip(class_ids, line_counts) if count}
+        results.append({
+            'line': line.name,
+            'total_vehicles': int(line_counts.sum()),
+            'vehicle_count': vehicle_count,
+        })
+    return results
+
+def _atomic_write_text(path, text):
+    """Write a text file so readers never see it half written"""
+    # Per-process temporary name, as several processes may write the same file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+class OverlayCompositor:
+    """
+    Blends cached overlay layers onto frames instead of redrawing them
+    
+    Rasterizing text with cv2.putText is a real share of frame time at high
+    resolutions, yet the counting line never moves and the counts change
+    only when a vehicle is counted. Each layer is drawn once on a black and
+    once on a white canvas, which gives its colour and (anti-aliasing)
+    coverage, cropped to the pixels drawn, and drawn again only when its key
+    changes. Frames only get the layer blended in within its bounding box,
+    matching what drawing on the frame gives to within rounding.
+    """
+    
+    def __init__(self):
+        # Name -> (key, frame shape, (y, x, premultiplied colour, 255 - alpha)
+        # or None if nothing was drawn)
+        self._layers = {}
+        # Layers rendered so far; stays flat while nothing changes
+        self.renders = 0
+    
+    def draw(self, frame, name, key, render, extent=None):
+        """
+        Blend a layer onto the frame, rendering it first if key changed
+        
+        Args:
+            frame: Frame to draw on, in place
+            name (str): Layer name; each name caches one layer
+            key: Anything comparable that changes whenever the layer's content does
+            render (callable): render(canvas) draws the layer on a blank canvas
+                               with the frame's coordinates
+            extent (tuple): (height, width) of the frame corner the layer stays
+                            in, to render on a smaller canvas, or a function
+                            returning it, called only when rendering (optional)
+        """
+        cached = self._layers.get(name)
+        if cached is None or cached[0] != key or cached[1] != frame.shape:
+            shape = frame.shape
+            if callable(extent):
+                extent = extent()
+            if extent is not None:
+                shape = (min(shape[0], extent[0]), min(shape[1], extent[1])) + shape[2:]
+            cached = (key, frame.shape, self._render(shape, render))
+            self._layers[name] = cached
+        
+        layer = cached[2]
+        if layer is not None:
+            y, x, colour, transparency = layer
+            region = frame[y:y + colour.shape[0], x:x + colour.shape[1]]
+            region[...] = cv2.add(colour, cv2.multiply(region, transparency, scale=1 / 255))
+        return frame
+    
+    def _render(self, shape, render):
+        self.renders += 1
+        on_black = np.zeros(shape, dtype=np.uint8)
+        on_white = np.full(shape, 255, dtype=np.uint8)
+        render(on_black)
+        render(on_white)
+        # What shows through of the white canvas is 255 - alpha, on every channel
+        transparency = (on_white - on_black).min(axis=2)
+        drawn = transparency < 255
+        rows = np.flatnonzero(drawn.any(axis=1))
+        if not len(rows):
+            return None
+        cols = np.flatnonzero(drawn.any(axis=0))
+        y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        transparency = np.repeat(transparency[y0:y1, x0:x1, None], shape[2], axis=2)
+        return (y0, x0, on_black[y0:y1, x0:x1].copy(), transparency)
 
 class VehicleCounter:
-    def __init__(self, model_path='yolov8n.pt', confidence_threshold=0.3):
+    def __init__(self, model_path='yolov8n.pt', confidence_threshold=0.3,
+                 max_track_age=300, max_tracks=1024, model=None, backend='torch', int8=False):
         """
         Initialize the vehicle counter with YOLO model
         
         Args:
             model_path (str): Path to YOLO model weights
             confidence_threshold (float): Minimum confidence for detections
+            max_track_age (int): Frames a track can go unseen before its state is dropped
+            max_tracks (int): Number of tracks whose state is kept at once
+            model: Already loaded model with a YOLO-style track() to use instead
+                   of loading model_path; predict() is optional and only used
+                   for warm-up and the built-in tracker; to be checkpointed, a model other than
+                   an Ultralytics one needs tracker_state() and
+                   restore_tracker_state(state)
+            backend (str): Inference backend, one of BACKENDS
+            int8 (bool): Run the INT8-quantized model (onnx and openvino backends)
         """
         # Load YOLO model
-        self.model = YOLO(model_path)
+        start = time.perf_counter()
+        self.model = model if model is not None else load_model(model_path, backend, int8)
+        self.model_load_seconds = time.perf_counter() - start
+        self.model_path = model_path
+        self.backend = backend
+        self.int8 = int8
+        
+        # A model passed in may be shared with other counters, so this counter
+        # keeps its own tracker state and swaps it in around each call
+        self._shared_model = model is not None
+        self._trackers = None
         self.confidence_threshold = confidence_threshold
         
-        # Vehicle class IDs from COCO dataset
-        self.vehicle_classes = {
-            2: 'car',
-            3: 'motorcycle', 
-            5: 'bus',
-            7: 'truck'
-        }
+        # Vehicle class IDs from COCO dataset
+        self.vehicle_classes = {
+            2: 'car',
+            3: 'motorcycle', 
+            5: 'bus',
+            7: 'truck'
+        }
+        self._vehicle_class_ids = np.array(list(self.vehicle_classes.keys()))
+        
+        # Detection filters applied before a box can be counted
+        self.min_count_confidence = 0.5
+        self.min_box_size = 30   # pixels
+        self.max_box_size = 400  # pixels
+        self.movement_threshold = 20  # pixels a track must move to be counted
+        self.history_length = 30  # center points kept per track
+        
+        # Tracking variables
+        self.track_history = TrackHistory(max_tracks, self.history_length, max_track_age)
+        self.vehicle_count = defaultdict(int)
+        self.total_vehicles = 0
+        
+        # Counts by time, for "last N minutes" and per-bucket history queries
+        self.rolling_counts = RollingCounts(self.vehicle_classes.values())
+        
+        # Time spent per frame in each processing stage
+        self.stage_timer = StageTimer()
+        
+        # Line for counting (you can adjust these coordinates)
+        self.counting_line_y = None
+        
+        # Counting line and count panel layers, redrawn only when they change
+        self.overlay = OverlayCompositor()
+        
+        # Index of the last frame counted, used to stamp counting events
+        self.frame_index = -1
+        
+        # Seconds a live frame may take from capture to counted
+        self.latency_budget = 1.0
+        
+        # Detector runs on a blank frame before counting starts, so first-call
+        # setup isn't paid inside the timed loop
+        self.warmup_runs = 1
+        
+        # Print every counted vehicle and the model's per-frame log; off by
+        # default because stdout in the counting loop is not free
+        self.verbose = False
+        
+        # Optional EventSink receiving counting events and count snapshots
+        self.event_sink = None
+        
+        # Optional ClipRecorder writing clips around counting activity
+        self.clip_recorder = None
+        
+        # Optional MotionGate that skips inference on static frames
+        self.motion_gate = None
+        
+        # Optional BoxTracker used instead of the model's tracker, so the
+        # detector only has to run every few frames
+        self.box_tracker = None
+        
+        # Optional InferenceRegion limiting the detector to ROI polygons or tiles
+        self.inference_region = None
+        
+        # Optional AdaptiveResolution adjusting input size and frame stride
+        # to keep inference within a latency target
+        self.adaptive_resolution = None
+        
+        # Tracker output being replayed from, or recorded to, a DetectionCache
+        self._cache_replay = None
+        self._cache_writer = None
+        
+    def setup_counting_line(self, frame_height, line_position=0.5):
+        """
+        Setup the counting line position
+        
+        Args:
+            frame_height (int): Height of the video frame
+            line_position (float): Position of line as fraction of frame height (0.5 = middle)
+        """
+        self.counting_line_y = int(frame_height * line_position)
+        
+    def draw_counting_line(self, frame):
+        """Draw the counting line on the frame"""
+        if self.counting_line_y is not None:
+            cv2.line(frame, (0, self.counting_line_y), 
+                    (frame.shape[1], self.counting_line_y), (0, 255, 0), 2)
+            cv2.putText(frame, "COUNTING LINE", (10, self.counting_line_y - 10),
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+    
+    def has_crossed_line(self, track_points, track_id):
+        """
+        Check if a vehicle has crossed the counting line
+        
+        Args:
+            track_points (list): List of center points for the track
+            track_id (int): Unique ID of the tracked object
+            
+        Returns:
+            bool: True if vehicle crossed the line
+        """
+        return self.crossing_direction(track_points, track_id) is not None
+    
+    def crossing_direction(self, track_points, track_id):
+        """
+        Check which way a vehicle crossed the counting line, if it did
+        
+        Args:
+            track_points (list): List of center points for the track
+            track_id (int): Unique ID of the tracked object
+            
+        Returns:
+            str: 'down' or 'up' if the vehicle crossed the line, otherwise None
+        """
+        if len(track_points) < 2 or self.track_history.is_counted(track_id):
+            return None
+            
+        # Check if the vehicle crossed the counting line
+        prev_y = track_points[-2][1]
+        curr_y = track_points[-1][1]
+        
+        # Vehicle crossed from top to bottom
+        if prev_y < self.counting_line_y <= curr_y:
+            self.track_history.mark_counted(track_id)
+            return 'down'
+            
+        # Vehicle crossed from bottom to top  
+        elif prev_y > self.counting_line_y >= curr_y:
+            self.track_history.mark_counted(track_id)
+            return 'up'
+            
+        return None
+    
+    def process_frame(self, frame):
+        """
+        Process a single frame for vehicle detection and counting
+        
+        Args:
+            frame: Input video frame
+            
+        Returns:
+            processed_frame: Frame with annotations
+        """
+        detections = self.detect_and_count(frame)
+        return self.annotate_frame(frame, detections)
+    
+    def detect_and_count(self, frame):
+        """
+        Run tracking on a frame and update the vehicle counts
+        
+        Args:
+            frame: Input video frame
+            
+        Returns:
+            list: (box, label, trail) tuples for the vehicles to annotate
+        """
+        return self.detect_and_count_batch([frame])[0].detections
+    
+    def detect_and_count_batch(self, frames, annotate=True):
+        """
+        Run tracking on several frames with one model call, then count each in order
+        
+        The tracker still steps through the frames one at a time inside the call,
+        so track IDs and counts are the same as calling detect_and_count per frame.
+        
+        Args:
+            frames (list): Consecutive video frames
+            annotate (bool): Build boxes, labels and trails for drawing; skip this
+                             when the frames will not be shown or saved
+            
+        Returns:
+            list: A CountedFrame per input frame
+        """
+        counted = []
+        for tracked in self.track_batch(frames):
+            with self.stage_timer.measure('postprocess'):
+                detections, events = self._count_tracked(tracked, annotate)
+            counted.append(CountedFrame(detections, events, self.stats_snapshot()))
+        return counted
+    
+    def warm_up(self, frame_shape, runs=1):
+        """
+        Run the detector on blank frames before counting
+        
+        The first inference call sets up the predictor, allocates buffers and
+        compiles exported backends; doing that here keeps it out of the
+        counting loop and its fps. The model's predict() is used, so no
+        tracker state is created or changed; a model passed in with only
+        track() is left cold rather than have its tracker see blank frames.
+        
+        Args:
+            frame_shape (tuple): (height, width, channels) of the video's frames
+            runs (int): Detector calls to make
+            
+        Returns:
+            float: Seconds the warm-up took, or None if the model has no predict()
+        """
+        if not hasattr(self.model, 'predict'):
+            return None
+        start = time.perf_counter()
+        frame = np.zeros(frame_shape, dtype=np.uint8)
+        for _ in range(runs):
+            self._detect([frame])
+        return time.perf_counter() - start
+    
+    def track_batch(self, frames):
+        """
+        Get the tracker output for consecutive frames
+        
+        Replays the detection cache when one is loaded, otherwise runs the
+        model, and records the output when a new cache is being written.
+        
+        Args:
+            frames (list): Consecutive video frames (unused when replaying)
+            
+        Returns:
+            list: A TrackedBoxes per frame
+        """
+        if self._cache_replay is not None:
+            return [self._cache_replay.next_frame() for _ in frames]
+        
+        start = time.perf_counter()
+        if self.motion_gate is None and self.adaptive_resolution is None:
+            tracked = self._run_tracker(frames)
+        else:
+            # Skipped frames get no detections; the tracker resumes where it left off
+            run = [True] * len(frames)
+            if self.motion_gate is not None:
+                run = [self.motion_gate.should_run(frame) for frame in frames]
+            if self.adaptive_resolution is not None:
+                run = [self.adaptive_resolution.should_run() and r for r in run]
+            moving = iter(self._run_tracker([frame for frame, r in zip(frames, run) if r]))
+            tracked = [next(moving) if r else empty_tracked_boxes() for r in run]
+        seconds = time.perf_counter() - start
+        self.stage_timer.add('inference', seconds, len(frames))
+        if self.adaptive_resolution is not None:
+            self.adaptive_resolution.update(seconds, len(frames))
+        
+        if self._cache_writer is not None:
+            for boxes in tracked:
+                self._cache_writer.add_frame(boxes)
+        return tracked
+    
+    def _run_tracker(self, frames):
+        """Run the model's tracker on frames and convert its output"""
+        if not frames:
+            return []
+        
+        if self.box_tracker is not None:
+            return self._run_box_tracker(frames)
+        
+        region = self.inference_region
+        if region is not None:
+            if region.tiled:
+                raise ValueError("Tiled inference needs the built-in tracker: set box_tracker")
+            windows = [region.cut(frame)[0] for frame in frames]
+            frames = [image for image, _ in windows]
+        
+        if self._shared_model:
+            self._swap_in_trackers()
+        
+        # Run YOLO inference
+        results = self.model.track(frames, persist=True, conf=self.confidence_threshold,
+                                 classes=list(self.vehicle_classes.keys()), verbose=self.verbose,
+                                 **self._inference_options())
+        
+        if self._shared_model:
+            self._trackers = getattr(getattr(self.model, 'predictor', None), 'trackers', None)
+        
+        tracked = [_tracked_boxes_from_result(result) for result in results]
+        if region is not None:
+            # Back to full-frame coordinates, keeping only tracks inside the ROI
+            for i, ((_, offset), boxes) in enumerate(zip(windows, tracked)):
+                xywh = region.to_frame(boxes.xywh, offset)
+                keep = region.inside(xywh)
+                tracked[i] = TrackedBoxes(xywh[keep], boxes.track_ids[keep],
+                                          boxes.class_ids[keep], boxes.confidences[keep])
+        return tracked
+    
+    def _run_box_tracker(self, frames):
+        """Detect on the frames the BoxTracker asks for and track through the rest"""
+        due = [self.box_tracker.detection_due(i) for i in range(len(frames))]
+        detections = iter(self._detect([frame for frame, detect in zip(frames, due) if detect]))
+        
+        tracked = []
+        for detect in due:
+            if detect:
+                tracked.append(self.box_tracker.update(*next(detections)))
+            else:
+                tracked.append(self.box_tracker.predict())
+        return tracked
+    
+    def _detect(self, frames):
+        """
+        Run the detector alone on frames
+        
+        With an inference region every window of every frame goes to the
+        model in one batch, and each frame's windows are merged back into
+        full-frame detections.
+        
+        Returns:
+            list: (xywh, class_ids, confidences) per frame
+        """
+        if not frames:
+            return []
+        
+        region = self.inference_region
+        if region is None:
+            images = frames
+        else:
+            windows = [region.cut(frame) for frame in frames]
+            images = [image for frame_windows in windows for image, _ in frame_windows]
+        
+        results = self.model.predict(images, conf=self.confidence_threshold,
+                                     classes=list(self.vehicle_classes.keys()),
+                                     verbose=self.verbose, **self._inference_options())
+        detections = [_detections_from_result(result) for result in results]
+        if region is None:
+            return detections
+        
+        merged = []
+        start = 0
+        for frame_windows in windows:
+            end = start + len(frame_windows)
+            merged.append(region.merge(detections[start:end],
+                                       [offset for _, offset in frame_windows]))
+            start = end
+        return merged
+    
+    def _inference_options(self):
+        """Extra model call arguments: the adaptive input size, if there is one"""
+        if self.adaptive_resolution is None:
+            return {}
+        return {'imgsz': self.adaptive_resolution.imgsz}
+    
+    def _swap_in_trackers(self):
+        """Point a shared model's tracker slots at this counter's trackers"""
+        predictor = getattr(self.model, 'predictor', None)
+        trackers = getattr(predictor, 'trackers', None)
+        if trackers is None:
+            return  # The first track() call on the model creates them
+        
+        if self._trackers is None:
+            # This counter's first call: fresh trackers configured like the others
+            self._trackers = [type(tracker)(tracker.args) for tracker in trackers]
+        predictor.trackers = self._trackers
+    
+    def _count_tracked(self, tracked, annotate=True):
+        """
+        Update track history and counts from one frame's tracker output
+        
+        Filtering, movement distances and line crossings are computed with
+        NumPy over every box in the frame at once; only boxes that pass all
+        filters touch the per-track history.
+        
+        Returns:
+            tuple: (detections to draw, counting events for this frame)
+        """
+        self.frame_index += 1
+        detections = []
+        events = []
+        
+        boxes, track_ids, class_ids, confidences = tracked
+        if len(track_ids) == 0:
+            return detections, events
+        
+        # Vehicle class, confidence and box size filters as one mask
+        w = boxes[:, 2]
+        h = boxes[:, 3]
+        keep = (np.isin(class_ids, self._vehicle_class_ids)
+                & (confidences >= self.min_count_confidence)
+                & (w >= self.min_box_size) & (h >= self.min_box_size)
+                & (w <= self.max_box_size) & (h <= self.max_box_size))
+        if not keep.any():
+            return detections, events
+        
+        boxes = boxes[keep]
+        track_ids = track_ids[keep].tolist()
+        class_ids = class_ids[keep].tolist()
+        confidences = confidences[keep]
+        centers = boxes[:, :2].astype(np.int32)
+        
+        # Append the new centers and look up each track's oldest and previous point
+        slots = self.track_history.update(track_ids, centers, self.frame_index)
+        first_points = self.track_history.first_points(slots)
+        prev_points = self.track_history.previous_points(slots)
+        lengths = self.track_history.lengths[slots]
+        
+        # Ignore static objects and tracks seen only once
+        dist = np.hypot(*(centers - first_points).T)
+        moving = (lengths > 1) & (dist >= self.movement_threshold)
+        
+        # Crossings of the counting line in either direction
+        prev_y = prev_points[:, 1]
+        curr_y = centers[:, 1]
+        down = moving & (prev_y < self.counting_line_y) & (self.counting_line_y <= curr_y)
+        up = moving & (prev_y > self.counting_line_y) & (self.counting_line_y >= curr_y)
+        
+        for i in np.flatnonzero(down | up):
+            track_id = track_ids[i]
+            if self.track_history.counted[slots[i]]:
+                continue
+            self.track_history.counted[slots[i]] = True
+            direction = 'down' if down[i] else 'up'
+            events.append(self._record_count(track_id, class_ids[i], direction))
+        
+        if not annotate:
+            return detections, events
+        
+        # Bounding box corners
+        corners = np.empty((len(boxes), 4), dtype=boxes.dtype)
+        corners[:, :2] = boxes[:, :2] - boxes[:, 2:] / 2
+        corners[:, 2:] = boxes[:, :2] + boxes[:, 2:] / 2
+        corners = corners.astype(np.int32).tolist()
+        confidences = confidences.tolist()
+        
+        for i in np.flatnonzero(moving):
+            track_id = track_ids[i]
+            label = f"{self.vehicle_classes[class_ids[i]]} ID:{track_id} {confidences[i]:.2f}"
+            
+            # The trail is a copy, so later frames can't change it under the annotator
+            trail = self.track_history.trail(slots[i])
+            detections.append((tuple(corners[i]), label, trail))
+        
+        return detections, events
+    
+    def _record_count(self, track_id, class_id, direction):
+        """Add a vehicle to the counts and return its counting event"""
+        vehicle_type = self.vehicle_classes[class_id]
+        self.vehicle_count[vehicle_type] += 1
+        self.total_vehicles += 1
+        timestamp = time.time()
+        self.rolling_counts.add(timestamp, vehicle_type)
+        
+        if self.verbose:
+            print(f"Vehicle #{self.total_vehicles} detected: {vehicle_type} (ID: {track_id})")
+        
+        return {
+            'timestamp': timestamp,
+            'frame': self.frame_index,
+            'track_id': int(track_id),
+            'vehicle_type': vehicle_type,
+            'direction': direction,
+            'line': f"y={self.counting_line_y}",
+            'total': self.total_vehicles,
+        }
+    
+    def annotate_frame(self, frame, detections):
+        """
+        Draw boxes, labels and track trails on a copy of the frame
+        
+        Args:
+            frame: Input video frame
+            detections (list): Output of detect_and_count for this frame
+            
+        Returns:
+            annotated_frame: Frame with annotations
+        """
+        annotated_frame = frame.copy()
+        
+        for (x1, y1, x2, y2), label, trail in detections:
+            # Draw bounding box
+            cv2.rectangle(annotated_frame, (x1, y1), (x2, y2), (255, 0, 0), 2)
+            
+            # Draw label
+            cv2.putText(annotated_frame, label, (x1, y1 - 10),
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
+            
+            # Draw track trail
+            if len(trail) > 1:
+                cv2.polylines(annotated_frame, [trail], False, (0, 255, 255), 2)
+        
+        return annotated_frame
+    
+    def stats_snapshot(self):
+        """Return (total, per-type counts) as they are right now"""
+        return self.total_vehicles, dict(self.vehicle_count)
+    
+    def add_stats_overlay(self, frame, stats=None):
+        """
+        Add counting statistics overlay to the frame
+        
+        Args:
+            frame: Frame to draw on
+            stats (tuple): (total, per-type counts) to show instead of the live counts
+        """
+        for text, origin, scale, color in self._stats_overlay_lines(stats):
+            cv2.putText(frame, text, origin, cv2.FONT_HERSHEY_SIMPLEX, scale, color, 2)
+        return frame
+    
+    def _stats_overlay_lines(self, stats=None):
+        """(text, origin, font scale, color) of each line of the statistics overlay"""
+        total_vehicles, vehicle_count = stats if stats is not None else self.stats_snapshot()
+        y_offset = 30
+        
+        # Total count (changed color to red)
+        lines = [(f"Total Vehicles: {total_vehicles}", (10, y_offset), 0.8, (0, 0, 255))]  # (0, 0, 255) is red
+        y_offset += 30
+        
+        # Individual vehicle type counts
+        for vehicle_type, count in vehicle_count.items():
+            text = f"{vehicle_type.capitalize()}: {count}"
+            lines.append((text, (10, y_offset), 0.6, (255, 255, 255)))
+            y_offset += 25
+        
+        return lines
+    
+    def _stats_overlay_extent(self, stats):
+        """(height, width) of the frame corner the statistics overlay draws in"""
+        bottom = right = 0
+        for text, (x, y), scale, _ in self._stats_overlay_lines(stats):
+            (width, _), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, 2)
+            right = max(right, x + width)
+            bottom = max(bottom, y + baseline)
+        # Thick strokes spill a few pixels past the text box
+        return bottom + 4, right + 4
+    
+    def process_video(self, video_path, output_path=None, display_video=True,
+                      pipelined=False, queue_size=8, batch_size=1, cache_dir=None,
+                      line_position=0.5, decode_process=False, live=False,
+                      live_buffer=1, simulate_live=False, checkpoint_path=None,
+                      checkpoint_every=60.0, resume=False):
+        """
+        Process entire video for vehicle counting
+        
+        Args:
+            video_path (str): Path to input video file
+            output_path (str): Path to save output video (optional)
+            display_video (bool): Whether to display video in real-time
+            pipelined (bool): Run decode, inference and encode as separate stages
+            queue_size (int): Frames buffered between pipeline stages
+            batch_size (int): Frames sent to the model per inference call
+            cache_dir (str): Directory of the detection cache; tracker output is
+                             replayed from it when this video was seen before
+                             and saved to it otherwise (optional)
+            line_position (float): Counting line position as fraction of frame height
+            decode_process (bool): Decode in a separate process that passes frames
+                                   through a shared-memory ring
+            live (bool): Treat the source as live: read on a grabber thread that
+                         drops the oldest frames when counting falls behind
+            live_buffer (int): Newest frames the live grabber keeps
+            simulate_live (bool): Play a video file back in real time as if it
+                                  were a camera (implies live)
+            checkpoint_path (str): Save counting state here periodically (optional)
+            checkpoint_every (float): Seconds of video between checkpoints
+            resume (bool): Continue from the checkpoint at checkpoint_path if there is one
+            
+        Returns:
+            dict: Final counts, the number of frames processed, the list of
+                  counting events and seconds spent loading the model, warming
+                  it up and processing
+        """
+        # Nothing will look at annotated frames, so don't make any
+        annotate = (display_video or output_path is not None
+                    or self.clip_recorder is not None)
+        live = live or simulate_live
+        resume = resume and checkpoint_path is not None and os.path.exists(checkpoint_path)
+        if checkpoint_path and (live or pipelined or decode_process):
+            # Only the serial loop has counted exactly the frames it has finished
+            print("Checkpoints need the serial loop: not pipelining or decoding out of process")
+            pipelined = decode_process = False
+            if live:
+                print("Live sources can't be resumed, so no checkpoints are saved")
+                checkpoint_path = None
+        if checkpoint_path and not self._tracking_checkpointable():
+            raise ValueError("Checkpoints need the Ultralytics trackers, the built-in tracker or "
+                             "a model with tracker_state() and restore_tracker_state()")
+        
+        cache = None
+        cache_key = None
+        if cache_dir and live:
+            print("Live sources drop frames, so the detection cache is not used")
+        elif cache_dir and self.adaptive_resolution is not None:
+            print("Adaptive resolution depends on timing, so the detection cache is not used")
+        elif cache_dir and resume:
+            print("Resuming from a checkpoint, so the detection cache is not used")
+        elif cache_dir:
+            cache = DetectionCache(cache_dir)
+            cache_key = self._cache_key(cache, video_path)
+            self._cache_replay = cache.load(cache_key)
+        
+        if self._cache_replay is not None and not annotate:
+            # Counting only needs the cached tracker output, not the pixels
+            print("Replaying cached tracker output, video frames are not decoded")
+            cap = self._cache_replay
+        else:
+            cap = _open_source(video_path)
+        
+        if not cap.isOpened():
+            self._cache_replay = None
+            raise ValueError(f"Could not open video file: {video_path}")
+        
+        # Get video properties
+        fps = int(cap.get(cv2.CAP_PROP_FPS))
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        
+        print(f"Processing video: {width}x{height} @ {fps}fps, {total_frames} frames")
+        
+        warm_up_seconds = 0.0
+        if self._cache_replay is None and self.warmup_runs > 0:
+            warm_up_seconds = self.warm_up((height, width, 3), self.warmup_runs)
+            if warm_up_seconds is None:
+                print("Model has no predict(), so it isn't warmed up")
+                warm_up_seconds = 0.0
+            else:
+                print(f"Model warm-up: {warm_up_seconds:.2f}s, not included in processing speed")
+        
+        # Setup counting line (middle of frame by default)
+        self.setup_counting_line(height, line_position)
+        
+        if self._cache_replay is not None:
+            print(f"Using cached tracker output: {cache.path(cache_key)}")
+        elif cache is not None:
+            self._cache_writer = DetectionCacheWriter(cache.path(cache_key), fps, width, height)
+        
+        # Setup video writer if output path is provided
+        out = None
+        if output_path:
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+            out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+        
+        if self.clip_recorder is not None:
+            self.clip_recorder.open(video_path, fps, self.render_frame)
+        
+        if not annotate:
+            print("No display or output video: counting only, frames are not annotated")
+        
+        progress = _Progress(fps, total_frames)
+        events = []
+        live_stats = None
+        
+        checkpoint = None
+        if checkpoint_path:
+            if resume:
+                progress.frame_count, events = self.load_checkpoint(checkpoint_path, video_path)
+                cap.set(cv2.CAP_PROP_POS_FRAMES, progress.frame_count)
+                print(f"Resuming from checkpoint at frame {progress.frame_count}: "
+                      f"{self.total_vehicles} vehicles counted so far")
+                if self.event_sink is not None and events:
+                    # The sink starts its files afresh, so they need the earlier events too
+                    self.event_sink.write(events)
+                if output_path:
+                    print("The output video only covers the resumed part")
+            checkpoint = (checkpoint_path, max(1, int(checkpoint_every * max(fps, 1))), video_path)
+        
+        processing_start = time.perf_counter()
+        try:
+            if live:
+                live_stats = self._run_live(cap, out, display_video, annotate, events, progress,
+                                            batch_size, live_buffer, fps if simulate_live else None)
+                completed = False
+            elif decode_process and cap is not self._cache_replay:
+                completed = self._run_shared_ring(video_path, cap, out, display_video, annotate,
+                                                  events, progress, queue_size, batch_size)
+            elif pipelined:
+                completed = self._run_pipelined(cap, out, display_video, annotate, events,
+                                                progress, queue_size, batch_size)
+            else:
+                completed = self._run_serial(cap, out, display_video, annotate, events,
+                                             progress, batch_size, checkpoint)
+            
+            if completed and checkpoint_path and os.path.exists(checkpoint_path):
+                # Nothing left to resume
+                os.remove(checkpoint_path)
+            
+            # Only a full pass over the video is worth caching
+            if completed and self._cache_writer is not None:
+                self._cache_writer.save()
+                print(f"Saved tracker output to cache: {self._cache_writer.path}")
+        
+        except KeyboardInterrupt:
+            print("Processing interrupted by user")
+        
+        finally:
+            # Cleanup
+            self._cache_replay = None
+            self._cache_writer = None
+            cap.release()
+            if out:
+                out.release()
+            if display_video:
+                cv2.destroyAllWindows()
+            if self.clip_recorder is not None:
+                self.clip_recorder.close()
+                clip_frames = sum(clip['frames'] for clip in self.clip_recorder.clips)
+                print(f"Wrote {len(self.clip_recorder.clips)} clips ({clip_frames} of "
+                      f"{progress.frame_count} frames) to {self.clip_recorder.directory}")
+            if self.adaptive_resolution is not None:
+                print(f"Adaptive resolution: {len(self.adaptive_resolution.changes)} changes, "
+                      f"ended at imgsz {self.adaptive_resolution.imgsz}, "
+                      f"stride {self.adaptive_resolution.stride}")
+            
+            if self.event_sink is not None:
+                self.event_sink.update(progress.frame_count, self.stats_snapshot(), force=True)
+            
+            # Print final results
+            if live_stats is not None:
+                latency = live_stats['latency']
+                print(f"Live: {live_stats['dropped_frames']} of {live_stats['grabbed_frames']} "
+                      f"frames dropped; capture-to-count latency p50 {latency['p50']:.3f}s, "
+                      f"p95 {latency['p95']:.3f}s, max {latency['max']:.3f}s, "
+                      f"{latency['over_budget']} frames over {self.latency_budget:g}s")
+            self.stage_timer.print_summary()
+            if self.motion_gate is not None:
+                print(f"Motion gate skipped inference on {self.motion_gate.frames_skipped} "
+                      f"of {self.motion_gate.frames_checked} frames")
+            self.print_final_results()
+        
+        result = {
+            'total_vehicles': self.total_vehicles,
+            'vehicle_count': dict(self.vehicle_count),
+            'frames': progress.frame_count,
+            'events': events,
+            'timing': {
+                'model_load': self.model_load_seconds,
+                'warm_up': warm_up_seconds,
+                'processing': time.perf_counter() - processing_start,
+            },
+        }
+        if live_stats is not None:
+            result['live'] = live_stats
+        return result
+    
+    def _run_serial(self, cap, out, display_video, annotate, events, progress, batch_size,
+                    checkpoint=None):
+        """
+        Read, count and write frames one batch after another on this thread
+        
+        Args:
+            checkpoint (tuple): (path, frames between saves, video path) to
+                                checkpoint the counting state (optional)
+        
+        Returns:
+            bool: True if the whole video was processed
+        """
+        if checkpoint is not None:
+            checkpoint_path, checkpoint_frames, video_path = checkpoint
+            next_checkpoint = progress.frame_count + checkpoint_frames
+        
+        while True:
+            start = time.perf_counter()
+            frames = _read_frames(cap, batch_size)
+            self.stage_timer.add('decode', time.perf_counter() - start, len(frames))
+            if not frames:
+                return True
+            
+            # Process frames for vehicle detection and counting
+            counted = self.detect_and_count_batch(frames, annotate)
+            
+            for frame, result in zip(frames, counted):
+                if not self._finish_frame(frame, result, out, display_video, annotate,
+                                          events, progress):
+                    return False
+            
+            if checkpoint is not None and progress.frame_count >= next_checkpoint:
+                self.save_checkpoint(checkpoint_path, video_path, progress.frame_count, events)
+                next_checkpoint = progress.frame_count + checkpoint_frames
+            
+            if len(frames) < batch_size:
+                return True
+    
+    def _run_pipelined(self, cap, out, display_video, annotate, events, progress,
+                       queue_size, batch_size):
+        """
+        Run decode, inference+counting and annotation/encode as three stages
+        
+        Decode and inference each get a worker thread; annotation, encoding and
+        display stay on the calling thread because cv2.imshow must. The stages
+        are joined by bounded FIFO queues, so frames leave in decode order and
+        counting sees them in exactly the order the serial path would.
+        
+        Returns:
+            bool: True if the whole video was processed
+        """
+        decoded = queue.Queue(maxsize=queue_size)
+        counted = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        errors = []
+        
+        def decode_stage():
+            try:
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    self.stage_timer.add('decode', time.perf_counter() - start)
+                    if not _put_until_stopped(decoded, frame, stop):
+                        break
+            except Exception as e:
+                errors.append(e)
+            finally:
+                _put_until_stopped(decoded, _END_OF_STREAM, stop)
+        
+        def inference_stage():
+            try:
+                finished = False
+                while not finished:
+                    frames = []
+                    while len(frames) < batch_size:
+                        frame = _get_until_stopped(decoded, stop)
+                        if frame is _END_OF_STREAM:
+                            finished = True
+                            break
+                        frames.append(frame)
+                    if not frames:
+                        break
+                    for frame, result in zip(frames, self.detect_and_count_batch(frames, annotate)):
+                        # Don't hold on to frames nobody will draw on
+                        item = (frame if annotate else None, result)
+                        if not _put_until_stopped(counted, item, stop):
+                            return
+            except Exception as e:
+                errors.append(e)
+            finally:
+                _put_until_stopped(counted, _END_OF_STREAM, stop)
+        
+        workers = [threading.Thread(target=decode_stage, name='decode', daemon=True),
+                   threading.Thread(target=inference_stage, name='inference', daemon=True)]
+        for worker in workers:
+            worker.start()
+        
+        completed = False
+        try:
+            while True:
+                item = _get_until_stopped(counted, stop)
+                if item is _END_OF_STREAM:
+                    completed = True
+                    break
+                frame, result = item
+                
+                if not self._finish_frame(frame, result, out, display_video, annotate,
+                                          events, progress):
+                    break
+        finally:
+            # Stop the workers before the caller releases the capture
+            stop.set()
+            for worker in workers:
+                worker.join()
+        
+        if errors:
+            raise errors[0]
+        return completed
+    
+    def _run_live(self, cap, out, display_video, annotate, events, progress, batch_size,
+                  buffer_size, simulate_fps):
+        """
+        Count the newest frames of a live source until it ends or the user stops
+        
+        Each batch is whatever the grabber holds, up to batch_size, so a slow
+        model skips stale frames instead of falling behind. Frames are counted
+        under their source frame numbers, so track ages and event frames stay
+        in source time across drops.
+        
+        Returns:
+            dict: Frames grabbed and dropped, and capture-to-count latency stats
+        """
+        grabber = LiveFrameGrabber(cap, buffer_size, simulate_fps, self.stage_timer).start()
+        latency = LatencyStats(self.latency_budget)
+        try:
+            while True:
+                batch = grabber.read(batch_size)
+                if not batch:
+                    break
+                
+                frames = [frame for frame, _, _ in batch]
+                tracked = self.track_batch(frames)
+                stopped = False
+                for (frame, captured, frame_number), boxes in zip(batch, tracked):
+                    self.frame_index = frame_number - 1
+                    with self.stage_timer.measure('postprocess'):
+                        detections, frame_events = self._count_tracked(boxes, annotate)
+                    latency.add(time.monotonic() - captured)
+                    result = CountedFrame(detections, frame_events, self.stats_snapshot())
+                    if not self._finish_frame(frame, result, out, display_video, annotate,
+                                              events, progress):
+                        stopped = True
+                        break
+                if stopped:
+                    break
+        finally:
+            grabber.stop()
+        
+        return {
+            'grabbed_frames': grabber.grabbed,
+            'dropped_frames': grabber.dropped,
+            'latency': latency.summary(),
+        }
+    
+    def _run_shared_ring(self, video_path, cap, out, display_video, annotate, events,
+                         progress, queue_size, batch_size):
+        """
+        Decode in a child process and count here, sharing frames through a SharedFrameRing
+        
+        The ring has queue_size + batch_size slots so the decoder keeps working
+        while a batch is being counted. A slot goes back to the decoder only
+        after its frame has been counted, annotated and written.
+        
+        Returns:
+            bool: True if the whole video was processed
+        """
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        # The decoder opens its own capture; cameras can't be opened twice
+        cap.release()
+        
+        context = multiprocessing.get_context('spawn')
+        ring = SharedFrameRing((height, width, 3), queue_size + batch_size, context)
+        stop = context.Event()
+        decoder = context.Process(target=_decode_to_ring, args=(video_path, ring.handle(), stop),
+                                  name='decode', daemon=True)
+        decoder.start()
+        
+        completed = False
+        try:
+            finished = False
+            while not finished:
+                slots = []
+                while len(slots) < batch_size:
+                    slot = ring.next_filled(timeout=0.5)
+                    if slot is _END_OF_STREAM:
+                        if not decoder.is_alive():
+                            if decoder.exitcode == _DECODER_OPEN_FAILED:
+                                raise ValueError(f"Could not open video file: {video_path}")
+                            raise RuntimeError(f"Decoder process exited with code {decoder.exitcode}")
+                        continue
+                    if slot is None:
+                        finished = True
+                        break
+                    slots.append(slot)
+                if not slots:
+                    break
+                
+                frames = [ring.frames[slot] for slot in slots]
+                counted = self.detect_and_count_batch(frames, annotate)
+                stopped = False
+                for slot, frame, result in zip(slots, frames, counted):
+                    if not stopped and not self._finish_frame(frame, result, out, display_video,
+                                                              annotate, events, progress):
+                        stopped = True
+                    ring.release(slot)
+                frames = counted = None
+                if stopped:
+                    return False
+            completed = True
+        finally:
+            stop.set()
+            decoder.join()
+            ring.close()
+        return completed
+    
+    def _finish_frame(self, frame, result, out, display_video, annotate, events, progress):
+        """
+        Collect a counted frame's events and annotate/save/display it if needed
+        
+        Returns:
+            bool: False if the user asked to stop
+        """
+        events.extend(result.events)
+        if self.event_sink is not None and result.events:
+            self.event_sink.write(result.events)
+        if self.clip_recorder is not None:
+            self.clip_recorder.add(progress.frame_count, frame, result)
+        
+        if (out or display_video) and not self._output_frame(frame, result.detections,
+                                                             result.stats, out, display_video):
+            return False
+        
+        progress.update(result.stats[0])
+        if self.event_sink is not None:
+            self.event_sink.update(progress.frame_count, result.stats)
+        return True
+    
+    def render_frame(self, frame, detections, stats=None):
+        """
+        Draw boxes, trails, the counting line and the counts on a copy of the frame
+        
+        Args:
+            frame: Input video frame
+            detections (list): Output of detect_and_count for this frame
+            stats (tuple): (total, per-type counts) to show instead of the live counts
+        
+        Returns:
+            annotated_frame: Frame with annotations
+        """
+        processed_frame = self.annotate_frame(frame, detections)
+        if stats is None:
+            stats = self.stats_snapshot()
+        total_vehicles, vehicle_count = stats
+        if self.counting_line_y is not None:
+            self.overlay.draw(processed_frame, 'line', self.counting_line_y,
+                              self.draw_counting_line, (self.counting_line_y + 4, frame.shape[1]))
+        self.overlay.draw(processed_frame, 'stats', (total_vehicles, tuple(vehicle_count.items())),
+                          lambda canvas: self.add_stats_overlay(canvas, stats),
+                          lambda: self._stats_overlay_extent(stats))
+        return processed_frame
+    
+    def _output_frame(self, frame, detections, stats, out, display_video):
+        """
+        Annotate, save and display one counted frame
+        
+        Returns:
+            bool: False if the user asked to stop
+        """
+        with self.stage_timer.measure('annotate'):
+            processed_frame = self.render_frame(frame, detections, stats)
+        
+        # Save frame if output video is specified
+        if out:
+            with self.stage_timer.measure('encode'):
+                out.write(processed_frame)
+        
+        # Display video if requested
+        if display_video:
+            with self.stage_timer.measure('display'):
+                cv2.imshow('Vehicle Counter', processed_frame)
+                key = cv2.waitKey(1) & 0xFF
+            if key == ord('q'):
+                print("Interrupted by user")
+                return False
+        
+        return True
+    
+    def save_checkpoint(self, path, video_path, frames_done, events):
+        """
+        Save everything needed to carry on counting after frames_done frames
+        
+        The model's tracker objects are pickled along with the track history,
+        counts and the state of the optional BoxTracker and MotionGate, so a
+        resumed run continues with the same track IDs and gives the same
+        results as an uninterrupted one. A model that isn't an Ultralytics
+        one saves its tracking state through its own tracker_state() and
+        restore_tracker_state(). The file is replaced atomically.
+        
+        Args:
+            path (str): Checkpoint file
+            video_path (str): Video being counted, checked on resume
+            frames_done (int): Frames counted so far
+            events (list): Counting events so far
+        """
+        state = {
+            'version': 1,
+            'video': os.path.abspath(video_path),
+            'model_path': self.model_path,
+            'frames_done': frames_done,
+            'frame_index': self.frame_index,
+            'counting_line_y': self.counting_line_y,
+            'vehicle_count': dict(self.vehicle_count),
+            'total_vehicles': self.total_vehicles,
+            'events': events,
+            'track_history': self.track_history,
+            'rolling_counts': self.rolling_counts,
+            'box_tracker': self.box_tracker,
+            'motion_gate': self.motion_gate,
+            'trackers': None,
+            'track_id_count': None,
+            'model_tracker_state': None,
+        }
+        if hasattr(self.model, 'tracker_state'):
+            state['model_tracker_state'] = self.model.tracker_state()
+        elif hasattr(self.model, 'predictor'):
+            state['trackers'] = self._current_trackers()
+            state['track_id_count'] = self._track_id_count()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    
+    def load_checkpoint(self, path, video_path):
+        """
+        Restore the counting state saved by save_checkpoint
+        
+        Args:
+            path (str): Checkpoint file
+            video_path (str): Video being counted; must be the one checkpointed
+            
+        Returns:
+            tuple: (frames already counted, counting events so far)
+        """
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != 1:
+            raise ValueError(f"Unsupported checkpoint: {path}")
+        if state['video'] != os.path.abspath(video_path) or state['model_path'] != self.model_path:
+            raise ValueError(f"Checkpoint {path} is for {state['video']} with {state['model_path']}")
+        
+        self.frame_index = state['frame_index']
+        self.counting_line_y = state['counting_line_y']
+        self.vehicle_count = defaultdict(int, state['vehicle_count'])
+        self.total_vehicles = state['total_vehicles']
+        self.track_history = state['track_history']
+        self.rolling_counts = state['rolling_counts']
+        self.box_tracker = state['box_tracker']
+        self.motion_gate = state['motion_gate']
+        if state.get('model_tracker_state') is not None:
+            self.model.restore_tracker_state(state['model_tracker_state'])
+        elif state['trackers'] is not None:
+            self._restore_trackers(state['trackers'], state['track_id_count'])
+        return state['frames_done'], state['events']
+    
+    def _tracking_checkpointable(self):
+        """Whether save_checkpoint can capture the tracking state this counter runs on"""
+        return (self.box_tracker is not None or hasattr(self.model, 'tracker_state')
+                or hasattr(self.model, 'predictor'))
+    
+    def _current_trackers(self):
+        """This counter's model tracker objects, if tracking has started"""
+        if self._shared_model:
+            return self._trackers
+        return getattr(getattr(self.model, 'predictor', None), 'trackers', None)
+    
+    def _track_id_count(self):
+        """Last track ID the Ultralytics trackers handed out; shared by all of them"""
+        from ultralytics.trackers.basetrack import BaseTrack
+        return BaseTrack._count
+    
+    def _restore_trackers(self, trackers, track_id_count):
+        """Put checkpointed tracker objects back in place of fresh ones"""
+        from ultralytics.trackers.basetrack import BaseTrack
+        BaseTrack._count = track_id_count
+        
+        if self._shared_model:
+            self._trackers = trackers
+        predictor = getattr(self.model, 'predictor', None)
+        if predictor is not None:
+            predictor.trackers = trackers
+            return
+        
+        # No predictor yet: Ultralytics makes fresh trackers when the first
+        # track() call starts unless some are already there, so hand these
+        # over just before, once
+        def restore(predictor):
+            if restore.pending and predictor.args.mode == 'track':
+                predictor.trackers = trackers
+                restore.pending = False
+        restore.pending = True
+        self.model.callbacks['on_predict_start'].insert(0, restore)
+    
+    def _cache_key(self, cache, video_path):
+        """Detection cache key for this counter's model and tracking settings"""
+        options = {}
+        if self.backend != 'torch' or self.int8:
+            options['backend'] = self.backend + ('-int8' if self.int8 else '')
+        if self.motion_gate is not None:
+            options['motion_gate'] = self.motion_gate.settings()
+        if self.box_tracker is not None:
+            options['box_tracker'] = self.box_tracker.settings()
+        if self.inference_region is not None:
+            options['inference_region'] = self.inference_region.settings()
+        return cache.key(video_path, self.model_path, self.confidence_threshold, options)
+    
+    def track_steps(self, cached):
+        """
+        Turn cached tracker output into the moves the counter would count on
+        
+        Applies the same class, confidence, size and movement filters as live
+        counting, and splits a track wherever it went unseen for longer than
+        the track history's max_age, as the live counter would forget it.
+        
+        Args:
+            cached (CachedTracks): Tracker output for a whole video
+            
+        Returns:
+            TrackSteps: Every qualifying move of every track
+        """
+        frames = np.repeat(np.arange(cached.frame_count), np.diff(cached.offsets))
+        w = cached.xywh[:, 2]
+        h = cached.xywh[:, 3]
+        keep = (np.isin(cached.class_ids, self._vehicle_class_ids)
+                & (cached.confidences >= self.min_count_confidence)
+                & (w >= self.min_box_size) & (h >= self.min_box_size)
+                & (w <= self.max_box_size) & (h <= self.max_box_size))
+        
+        track_ids = cached.track_ids[keep]
+        frames = frames[keep]
+        order = np.lexsort((frames, track_ids))
+        track_ids = track_ids[order]
+        frames = frames[order]
+        points = cached.xywh[keep][order, :2].astype(np.int32)
+        class_ids = cached.class_ids[keep][order]
+        
+        # A new track starts at a new ID or after a gap the live counter would evict
+        count = len(track_ids)
+        new_track = np.ones(count, dtype=bool)
+        new_track[1:] = ((track_ids[1:] != track_ids[:-1])
+                         | (frames[1:] - frames[:-1] > self.track_history.max_age))
+        track_index = np.cumsum(new_track) - 1
+        track_start = np.maximum.accumulate(np.where(new_track, np.arange(count), 0))
+        
+        # Movement is measured from the oldest point still in the history window
+        position = np.arange(count)
+        window_start = np.maximum(track_start, position - (self.history_length - 1))
+        dist = np.hypot(*(points - points[window_start]).T)
+        moving = ~new_track & (dist >= self.movement_threshold)
+        
+        step = np.flatnonzero(moving)
+        return TrackSteps(points[step - 1], points[step], track_index[step],
+                          class_ids[step], frames[step], int(new_track.sum()))
+    
+    def sweep_counting_lines(self, video_path, lines, cache_dir):
+        """
+        Count a cached video for many counting lines without running the model
+        
+        Args:
+            video_path (str): Path to a video already processed with cache_dir
+            lines (list): CountingLine objects to evaluate
+            cache_dir (str): Detection cache directory
+            
+        Returns:
+            list: Per line, a dict with the line name, total and per-type counts
+        """
+        cached = self.load_cached_tracks(video_path, cache_dir)
+        return count_line_crossings(self.track_steps(cached), lines, self.vehicle_classes)
+    
+    def load_cached_tracks(self, video_path, cache_dir):
+        """
+        Load this counter's cached tracker output for a video
+        
+        Raises:
+            ValueError: If the video has not been processed with this cache,
+                        model and confidence threshold yet
+        """
+        cache = DetectionCache(cache_dir)
+        cached = cache.load(self._cache_key(cache, video_path))
+        if cached is None:
+            raise ValueError(f"No cached tracker output for {video_path}; "
+                             f"process it once with cache_dir={cache_dir!r} first")
+        return cached
+    
+    def print_final_results(self):
+        """Print final counting results"""
+        print("\n" + "="*50)
+        print("FINAL VEHICLE COUNT RESULTS")
+        print("="*50)
+        print(f"Total Vehicles Counted: {self.total_vehicles}")
+        print("-" * 30)
+        
+        for vehicle_type, count in self.vehicle_count.items():
+            percentage = (count / self.total_vehicles * 100) if self.total_vehicles > 0 else 0
+            print(f"{vehicle_type.capitalize()}: {count} ({percentage:.1f}%)")
+        
+        print("="*50)
+
+def _read_frames(cap, count):
+    """Read up to count frames, fewer if the video ends"""
+    frames = []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    return frames
+
+class StageTimer:
+    """
+    Per-frame time spent in each processing stage, as histograms
+    
+    Stages are timed wherever they run, including the pipeline's worker
+    threads. Each stage keeps Prometheus-style cumulative bucket counts, a
+    running sum and count, and a window of recent samples for percentiles.
+    Batched stages record the batch time split evenly over its frames.
+    """
+    
+    STAGES = ('decode', 'inference', 'postprocess', 'annotate', 'encode', 'display')
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+    
+    def __init__(self, window=4096):
+        """
+        Args:
+            window (int): Recent samples per stage kept for percentiles
+        """
+        self._lock = threading.Lock()
+        self._buckets = {stage: np.zeros(len(self.BUCKETS) + 1, dtype=np.int64)
+                         for stage in self.STAGES}
+        self._sums = dict.fromkeys(self.STAGES, 0.0)
+        self._counts = dict.fromkeys(self.STAGES, 0)
+        self._recent = {stage: deque(maxlen=window) for stage in self.STAGES}
+    
+    @contextlib.contextmanager
+    def measure(self, stage, frames=1):
+        """Time the body of a with block as one run of stage over frames frames"""
+        start = time.perf_counter()
+        yield
+        self.add(stage, time.perf_counter() - start, frames)
+    
+    def add(self, stage, seconds, frames=1):
+        """
+        Record time spent in a stage
+        
+        Args:
+            stage (str): One of STAGES
+            seconds (float): Time taken for all the frames
+            frames (int): Frames processed in that time
+        """
+        if frames <= 0:
+            return
+        per_frame = seconds / frames
+        with self._lock:
+            self._buckets[stage][np.searchsorted(self.BUCKETS, per_frame)] += frames
+            self._sums[stage] += seconds
+            self._counts[stage] += frames
+            self._recent[stage].append(per_frame)
+    
+    def summary(self):
+        """
+        Returns:
+            dict: Stage -> frames, mean, p50, p95, p99 and max seconds per
+                  frame over the recent window, and total seconds
+        """
+        with self._lock:
+            stats = {}
+            for stage in self.STAGES:
+                if not self._counts[stage]:
+                    continue
+                recent = np.array(self._recent[stage])
+                p50, p95, p99 = np.percentile(recent, [50, 95, 99])
+                stats[stage] = {
+                    'frames': self._counts[stage],
+                    'mean': self._sums[stage] / self._counts[stage],
+                    'p50': p50, 'p95': p95, 'p99': p99, 'max': recent.max(),
+                    'total': self._sums[stage],
+                }
+            return stats
+    
+    def print_summary(self):
+        """Print a per-stage timing table"""
+        stats = self.summary()
+        if not stats:
+            return
+        total = sum(stage['total'] for stage in stats.values())
+        print(f"{'stage':<12} {'frames':>8} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'p99 ms':>8} {'max ms':>8} {'share':>6}")
+        for name, stage in stats.items():
+            print(f"{name:<12} {stage['frames']:>8} {stage['mean'] * 1e3:>8.2f} "
+                  f"{stage['p50'] * 1e3:>8.2f} {stage['p95'] * 1e3:>8.2f} "
+                  f"{stage['p99'] * 1e3:>8.2f} {stage['max'] * 1e3:>8.2f} "
+                  f"{stage['total'] / max(total, 1e-9) * 100:>5.1f}%")
+    
+    def prometheus_lines(self, prefix='vehicle_counter'):
+        """Stage histograms in the Prometheus text exposition format"""
+        name = f"{prefix}_stage_seconds"
+        lines = [f"# HELP {name} Time per frame spent in each processing stage",
+                 f"# TYPE {name} histogram"]
+        with self._lock:
+            for stage in self.STAGES:
+                cumulative = np.cumsum(self._buckets[stage])
+                for bound, count in zip(self.BUCKETS, cumulative):
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {cumulative[-1]}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {self._sums[stage]}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {self._counts[stage]}')
+        return lines
+
+class MetricsServer:
+    """
+    Local HTTP endpoint serving a counter's metrics at /metrics for Prometheus
+    
+    Serves the stage timing histograms, the vehicle totals by type and the
+    counts over the last 15 minutes, from a background thread.
+    """
+    
+    def __init__(self, counter, port=9108, host='127.0.0.1'):
+        """
+        Args:
+            counter (VehicleCounter): Counter to report on
+            port (int): Port to listen on
+            host (str): Address to bind; 127.0.0.1 keeps it local
+        """
+        self.counter = counter
+        self.server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self.server.metrics = self
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics',
+                                        daemon=True)
+    
+    @property
+    def port(self):
+        return self.server.server_address[1]
+    
+    def start(self):
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def render(self):
+        """Current metrics in the Prometheus text exposition format"""
+        counter = self.counter
+        lines = counter.stage_timer.prometheus_lines()
+        lines += ["# HELP vehicle_counter_vehicles_total Vehicles counted since start",
+                  "# TYPE vehicle_counter_vehicles_total counter"]
+        for vehicle_type in counter.vehicle_classes.values():
+            lines.append(f'vehicle_counter_vehicles_total{{type="{vehicle_type}"}} '
+                         f'{counter.vehicle_count.get(vehicle_type, 0)}')
+        lines += ["# HELP vehicle_counter_vehicles_last_15m Vehicles counted in the last 15 minutes",
+                  "# TYPE vehicle_counter_vehicles_last_15m gauge"]
+        recent = counter.rolling_counts.last(900)
+        for vehicle_type in counter.vehicle_classes.values():
+            lines.append(f'vehicle_counter_vehicles_last_15m{{type="{vehicle_type}"}} '
+                         f'{recent[vehicle_type]}')
+        lines += ["# HELP vehicle_counter_frame_index Index of the last frame counted",
+                  "# TYPE vehicle_counter_frame_index gauge",
+                  f"vehicle_counter_frame_index {counter.frame_index}"]
+        return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would flood the console
+
+class RollingCounts:
+    """
+    Per-class vehicle counts in fixed time buckets at several resolutions
+    
+    Each resolution keeps a ring of buckets, so memory is fixed and adding
+    a vehicle is O(1): find the bucket its timestamp falls in, clear it if it
+    still holds an older period, and increment one cell. By default there
+    are 1-minute buckets for a day, 15-minute buckets for a week and hourly
+    buckets for 30 days.
+    """
+    
+    def __init__(self, class_names, resolutions=(60, 900, 3600), retention=(1440, 672, 720)):
+        """
+        Args:
+            class_names (list): Vehicle types counted, e.g. ['car', 'bus']
+            resolutions (tuple): Bucket lengths in seconds
+            retention (tuple): Buckets kept per resolution
+        """
+        self.class_names = list(class_names)
+        self._class_index = {name: i for i, name in enumerate(self.class_names)}
+        self.resolutions = tuple(resolutions)
+        self.retention = dict(zip(self.resolutions, retention))
+        self._counts = {resolution: np.zeros((slots, len(self.class_names)), dtype=np.int64)
+                        for resolution, slots in self.retention.items()}
+        # Bucket number (timestamp // resolution) each slot currently holds
+        self._periods = {resolution: np.full(slots, -1, dtype=np.int64)
+                         for resolution, slots in self.retention.items()}
+    
+    def add(self, timestamp, vehicle_type, count=1):
+        """
+        Count vehicles at a time
+        
+        Args:
+            timestamp (float): Unix time of the count
+            vehicle_type (str): One of class_names
+            count (int): Vehicles to add
+        """
+        column = self._class_index[vehicle_type]
+        for resolution in self.resolutions:
+            period = int(timestamp // resolution)
+            slot = period % self.retention[resolution]
+            periods = self._periods[resolution]
+            if periods[slot] != period:
+                if period < periods[slot]:
+                    continue  # Older than anything this resolution still keeps
+                periods[slot] = period
+                self._counts[resolution][slot] = 0
+            self._counts[resolution][slot, column] += count
+    
+    def last(self, seconds, now=None):
+        """
+        Counts over the last seconds, to the nearest bucket
+        
+        Uses the finest resolution that still covers the window. The oldest
+        bucket is counted whole when the window starts inside it.
+        
+        Args:
+            seconds (float): Window length
+            now (float): End of the window (default: current time)
+            
+        Returns:
+            dict: Vehicle type -> count, plus 'total'
+        """
+        now = time.time() if now is None else now
+        # The window can straddle one more bucket than it is long
+        resolution = next((r for r in self.resolutions if r * (self.retention[r] - 1) >= seconds),
+                          self.resolutions[-1])
+        first = int((now - seconds) // resolution)
+        last = int(now // resolution)
+        periods = self._periods[resolution]
+        in_window = (periods >= first) & (periods <= last)
+        return self._as_dict(self._counts[resolution][in_window].sum(axis=0))
+    
+    def history(self, resolution, buckets=None, now=None):
+        """
+        Per-bucket counts at one resolution, oldest first, empty buckets included
+        
+        Args:
+            resolution (int): One of resolutions, in seconds
+            buckets (int): Number of most recent buckets (default: all retained)
+            now (float): Time of the newest bucket (default: current time)
+            
+        Returns:
+            list: (bucket start time, {vehicle type: count, 'total': n}) per bucket
+        """
+        if resolution not in self.retention:
+            raise ValueError(f"No {resolution}s buckets, have {self.resolutions}")
+        slots = self.retention[resolution]
+        buckets = slots if buckets is None else min(buckets, slots)
+        now = time.time() if now is None else now
+        last = int(now // resolution)
+        
+        periods = np.arange(last - buckets + 1, last + 1)
+        held = self._periods[resolution][periods % slots] == periods
+        counts = np.where(held[:, None], self._counts[resolution][periods % slots], 0)
+        return [(int(period) * resolution, self._as_dict(row)) for period, row in zip(periods, counts)]
+    
+    def _as_dict(self, row):
+        counts = {name: int(count) for name, count in zip(self.class_names, row)}
+        counts['total'] = int(row.sum())
+        return counts
+
+class EventSink:
+    """
+    Writes counting events and periodic count snapshots on a background thread
+    
+    The counting loop only puts records on a queue; a writer thread takes
+    whatever has piled up, writes it as one batch and flushes. Events go to
+    path and snapshots to a sibling file with ".snapshots" before the
+    extension, both as JSON lines (.jsonl), CSV (.csv) or Parquet
+    (.parquet, needs pyarrow).
+    """
+    
+    EVENT_FIELDS = ('timestamp', 'source', 'frame', 'track_id', 'vehicle_type',
+                    'direction', 'line', 'total')
+    SNAPSHOT_FIELDS = ('timestamp', 'source', 'frames', 'total', 'car', 'motorcycle',
+                       'bus', 'truck')
+    FORMATS = ('jsonl', 'csv', 'parquet')
+    
+    def __init__(self, path, snapshot_interval=10.0, batch_size=1024):
+        """
+        Args:
+            path (str): Events file; its extension picks the format
+            snapshot_interval (float): Seconds between aggregate count snapshots
+            batch_size (int): Most records written per batch
+        """
+        root, ext = os.path.splitext(path)
+        self.format = ext.lstrip('.').lower()
+        if self.format not in self.FORMATS:
+            raise ValueError(f"Unsupported event file {path!r}, expected one of: "
+                             + ', '.join('.' + name for name in self.FORMATS))
+        if self.format == 'parquet':
+            import pyarrow  # noqa: F401 -- fail here rather than on the writer thread
+        
+        self.path = path
+        self.snapshot_path = f"{root}.snapshots{ext}"
+        self.snapshot_interval = snapshot_interval
+        self.batch_size = batch_size
+        self.records_written = 0
+        self._next_snapshot = time.monotonic() + snapshot_interval
+        self._queue = queue.Queue()
+        self._errors = []
+        self._thread = threading.Thread(target=self._write_loop, name='events', daemon=True)
+        self._thread.start()
+    
+    def write(self, events, source=None):
+        """Queue counting events from VehicleCounter"""
+        for event in events:
+            self._queue.put(('event', dict(event, source=source)))
+    
+    def update(self, frames, stats, source=None, force=False):
+        """
+        Queue a snapshot of the counts if snapshot_interval has passed
+        
+        Args:
+            frames (int): Frames processed so far
+            stats (tuple): (total, per-type counts) from VehicleCounter.stats_snapshot()
+            source (str): Stream the counts belong to (optional)
+            force (bool): Snapshot now regardless of the interval
+        """
+        now = time.monotonic()
+        if not force and now < self._next_snapshot:
+            return
+        self._next_snapshot = now + self.snapshot_interval
+        total, counts = stats
+        snapshot = {'timestamp': time.time(), 'source': source, 'frames': frames,
+                    'total': total}
+        for vehicle_type in self.SNAPSHOT_FIELDS[4:]:
+            snapshot[vehicle_type] = counts.get(vehicle_type, 0)
+        self._queue.put(('snapshot', snapshot))
+    
+    def close(self):
+        """Write everything queued so far and close the files"""
+        self._queue.put(None)
+        self._thread.join()
+        if self._errors:
+            raise self._errors[0]
+    
+    def _write_loop(self):
+        writers = {}
+        try:
+            finished = False
+            while not finished:
+                batch = [self._queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    finished = True
+                    batch = batch[:batch.index(None)]
+                
+                for kind in ('event', 'snapshot'):
+                    records = [record for record_kind, record in batch if record_kind == kind]
+                    if records:
+                        if kind not in writers:
+                            writers[kind] = self._open(kind)
+                        writers[kind].write(records)
+                        self.records_written += len(records)
+        except Exception as e:
+            self._errors.append(e)
+        finally:
+            for writer in writers.values():
+                writer.close()
+    
+    def _open(self, kind):
+        path = self.path if kind == 'event' else self.snapshot_path
+        fields = self.EVENT_FIELDS if kind == 'event' else self.SNAPSHOT_FIELDS
+        if self.format == 'parquet':
+            return _ParquetRecordWriter(path, fields)
+        return _TextRecordWriter(path, fields, self.format)
+
+class _TextRecordWriter:
+    """JSON lines or CSV records, flushed after every batch"""
+    
+    def __init__(self, path, fields, format):
+        self.file = open(path, 'w', newline='')
+        self.fields = fields
+        self.csv = None
+        if format == 'csv':
+            self.csv = csv.DictWriter(self.file, fields, extrasaction='ignore')
+            self.csv.writeheader()
+    
+    def write(self, records):
+        if self.csv is not None:
+            self.csv.writerows(records)
+        else:
+            self.file.writelines(json.dumps({field: record.get(field) for field in self.fields}) + '\n'
+                                 for record in records)
+        self.file.flush()
+    
+    def close(self):
+        self.file.close()
+
+class _ParquetRecordWriter:
+    """Parquet records, one row group per batch"""
+    
+    STRING_FIELDS = ('source', 'vehicle_type', 'direction', 'line')
+    
+    def __init__(self, path, fields):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.fields = fields
+        self.schema = pyarrow.schema([
+            (field, pyarrow.float64() if field == 'timestamp' else
+             pyarrow.string() if field in self.STRING_FIELDS else pyarrow.int64())
+            for field in fields])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+    
+    def write(self, records):
+        columns = {field: [record.get(field) for record in records] for field in self.fields}
+        self.writer.write_table(self.pyarrow.Table.from_pydict(columns, schema=self.schema))
+    
+    def close(self):
+        self.writer.close()
+
+class ClipRecorder:
+    """
+    Writes short annotated clips around counting activity instead of a whole output video
+    
+    Counted frames wait, unannotated, in a ring holding the last pre_seconds
+    of video. A triggering frame (one with counting events, or with
+    trigger='detections' any moving vehicle) starts a clip with the ring's
+    frames, and the clip runs until post_seconds pass without another
+    trigger. Frames that never end up in a clip are never drawn on or
+    encoded, so disk and encode time follow the traffic rather than the
+    length of the video.
+    
+    With encode_process the clips are encoded in a child process that reads
+    annotated frames from a SharedFrameRing; counting only waits for it when
+    every slot is full.
+    """
+    
+    TRIGGERS = ('events', 'detections')
+    
+    def __init__(self, directory, pre_seconds=2.0, post_seconds=3.0, trigger='events',
+                 encode_process=False, encode_slots=16, stage_timer=None):
+        """
+        Args:
+            directory (str): Where clips are written, created if missing
+            pre_seconds (float): Video kept before the first trigger of a clip
+            post_seconds (float): Video kept after the last trigger of a clip
+            trigger (str): One of TRIGGERS
+            encode_process (bool): Encode in a separate process
+            encode_slots (int): Frames buffered for the encode process
+            stage_timer (StageTimer): Records annotate and encode times (optional)
+        """
+        if trigger not in self.TRIGGERS:
+            raise ValueError(f"Unknown clip trigger {trigger!r}, expected one of: "
+                             + ', '.join(self.TRIGGERS))
+        self.directory = directory
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.trigger = trigger
+        self.encode_process = encode_process
+        self.encode_slots = encode_slots
+        self.stage_timer = stage_timer
+        self.clips = []
+        self._pending = deque()
+        self._remaining = 0  # frames left in the clip being written, 0 between clips
+        self._writer = None
+        self._ring = None
+        self._encoder = None
+    
+    def open(self, source, fps, render):
+        """
+        Start recording clips of a video
+        
+        Args:
+            source (str): Input video; clip names start with its base name
+            fps (float): Frame rate of the input, and of the clips
+            render (callable): render(frame, detections, stats) returning the
+                               annotated frame
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.fps = fps or 30
+        self._name = os.path.splitext(os.path.basename(str(source)))[0] or 'clip'
+        self._render = render
+        self._pending = deque(maxlen=int(round(self.pre_seconds * self.fps)))
+        self._post_frames = max(1, int(round(self.post_seconds * self.fps)))
+        self._remaining = 0
+    
+    def add(self, frame_number, frame, counted):
+        """
+        Record one counted frame
+        
+        Args:
+            frame_number (int): Position of the frame in the video
+            frame: The frame as decoded
+            counted (CountedFrame): Its detections, events and counts
+        """
+        if self.trigger == 'events':
+            triggered = bool(counted.events)
+        else:
+            triggered = bool(counted.detections)
         
-        # Tracking variables
-        self.track_history = defaultdict(lambda: [])
-        self.vehicle_count = defaultdict(int)
-        self.total_vehicles = 0
+        if triggered and not self._remaining:
+            self._start_clip(frame_number - len(self._pending))
+            while self._pending:
+                self._write(*self._pending.popleft())
+        if triggered:
+            self._remaining = self._post_frames
         
-        # Line for counting (you can adjust these coordinates)
-        self.counting_line_y = None
-        self.counted_ids = set()
+        if self._remaining:
+            self._write(frame, counted.detections, counted.stats)
+            self._remaining -= 1
+            if not self._remaining:
+                self._end_clip()
+        elif self._pending.maxlen:
+            # Frames decoded into a shared-memory slot are overwritten once released
+            if not frame.flags.owndata:
+                frame = frame.copy()
+            self._pending.append((frame, counted.detections, counted.stats))
+    
+    def close(self):
+        """Finish the clip being written and stop the encode process"""
+        if self._remaining:
+            self._remaining = 0
+            self._end_clip()
+        self._pending.clear()
+        if self._encoder is not None:
+            self._ring.publish(None)
+            self._encoder.join()
+            self._ring.close()
+            exitcode = self._encoder.exitcode
+            self._ring = self._encoder = None
+            if exitcode:
+                raise RuntimeError(f"Clip encoder process exited with code {exitcode}")
+    
+    def _start_clip(self, first_frame):
+        path = os.path.join(self.directory, f"{self._name}_{first_frame:08d}.mp4")
+        self.clips.append({'path': path, 'first_frame': first_frame, 'frames': 0})
+    
+    def _end_clip(self):
+        if self._encoder is not None:
+            self._ring.publish((self.clips[-1]['path'], None))
+        elif self._writer is not None:
+            self._writer.release()
+            self._writer = None
+    
+    def _write(self, frame, detections, stats):
+        with self._measure('annotate'):
+            image = self._render(frame, detections, stats)
         
-    def setup_counting_line(self, frame_height, line_position=0.5):
+        path = self.clips[-1]['path']
+        with self._measure('encode'):
+            if self.encode_process:
+                if self._encoder is None:
+                    self._start_encoder(image.shape)
+                slot = self._acquire_slot()
+                self._ring.frames[slot] = image
+                self._ring.publish((path, slot))
+            else:
+                if self._writer is None:
+                    height, width = image.shape[:2]
+                    self._writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'),
+                                                   self.fps, (width, height))
+                self._writer.write(image)
+        self.clips[-1]['frames'] += 1
+    
+    def _start_encoder(self, shape):
+        context = multiprocessing.get_context('spawn')
+        self._ring = SharedFrameRing(shape, self.encode_slots, context)
+        self._encoder = context.Process(target=_encode_clips, args=(self._ring.handle(), self.fps),
+                                        name='encode', daemon=True)
+        self._encoder.start()
+    
+    def _acquire_slot(self):
+        while True:
+            slot = self._ring.acquire(timeout=0.5)
+            if slot is not None:
+                return slot
+            if not self._encoder.is_alive():
+                raise RuntimeError(f"Clip encoder process exited with code {self._encoder.exitcode}")
+    
+    def _measure(self, stage):
+        if self.stage_timer is None:
+            return contextlib.nullcontext()
+        return self.stage_timer.measure(stage)
+
+def _encode_clips(ring_handle, fps):
+    """Encoder process: write (clip path, slot) frames from the ring until None arrives"""
+    ring = SharedFrameRing.attach(*ring_handle)
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    writer = None
+    writer_path = None
+    try:
+        while True:
+            message = ring.next_filled()
+            if message is None:
+                break
+            path, slot = message
+            if slot is None:
+                # End of the clip at path
+                if writer is not None:
+                    writer.release()
+                writer = writer_path = None
+                continue
+            if path != writer_path:
+                if writer is not None:
+                    writer.release()
+                writer = cv2.VideoWriter(path, fourcc, fps, (ring.shape[1], ring.shape[0]))
+                writer_path = path
+            writer.write(ring.frames[slot])
+            ring.release(slot)
+    finally:
+        if writer is not None:
+            writer.release()
+        ring.close()
+
+class LiveFrameGrabber:
+    """
+    Background reader that keeps only the newest frames of a live source
+    
+    A camera or RTSP stream doesn't wait for the counter: if frames are read
+    slower than they arrive, cap.read() falls further and further behind
+    real time. The grabber reads on its own thread as fast as frames come in
+    and keeps at most buffer_size of them, dropping the oldest when the
+    counter falls behind, so what gets counted is always recent.
+    
+    With simulate_fps a video file stands in for a camera: frames are
+    released at that rate whether or not the counter keeps up.
+    """
+    
+    def __init__(self, cap, buffer_size=1, simulate_fps=None, stage_timer=None):
         """
-        Setup the counting line position
-        
         Args:
-            frame_height (int): Height of the video frame
-            line_position (float): Position of line as fraction of frame height (0.5 = middle)
+            cap: Opened cv2.VideoCapture
+            buffer_size (int): Newest frames kept for the counter
+            simulate_fps (float): Play a file back at this real-time rate (optional)
+            stage_timer (StageTimer): Records decode times (optional)
         """
-        self.counting_line_y = int(frame_height * line_position)
-        
-    def draw_counting_line(self, frame):
-        """Draw the counting line on the frame"""
-        if self.counting_line_y is not None:
-            cv2.line(frame, (0, self.counting_line_y), 
-                    (frame.shape[1], self.counting_line_y), (0, 255, 0), 2)
-            cv2.putText(frame, "COUNTING LINE", (10, self.counting_line_y - 10),
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+        self.cap = cap
+        self.stage_timer = stage_timer
+        self.simulate_fps = simulate_fps
+        self.grabbed = 0
+        self.dropped = 0
+        self._buffer = deque(maxlen=max(1, buffer_size))
+        self._ready = threading.Condition()
+        self._ended = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._grab, name='grab', daemon=True)
     
-    def has_crossed_line(self, track_points, track_id):
+    def start(self):
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+    
+    def read(self, max_frames=1):
         """
-        Check if a vehicle has crossed the counting line
+        Wait for and take the buffered frames, oldest first
         
-        Args:
-            track_points (list): List of center points for the track
-            track_id (int): Unique ID of the tracked object
-            
         Returns:
-            bool: True if vehicle crossed the line
+            list: Up to max_frames (frame, capture time, frame number) tuples;
+                  empty once the source has ended
         """
-        if len(track_points) < 2 or track_id in self.counted_ids:
-            return False
-            
-        # Check if the vehicle crossed the counting line
-        prev_y = track_points[-2][1]
-        curr_y = track_points[-1][1]
-        
-        # Vehicle crossed from top to bottom
-        if prev_y < self.counting_line_y <= curr_y:
-            self.counted_ids.add(track_id)
-            return True
-            
-        # Vehicle crossed from bottom to top  
-        elif prev_y > self.counting_line_y >= curr_y:
-            self.counted_ids.add(track_id)
-            return True
-            
-        return False
+        with self._ready:
+            while not self._buffer and not self._ended:
+                self._ready.wait(0.1)
+            count = min(max_frames, len(self._buffer))
+            return [self._buffer.popleft() for _ in range(count)]
     
-    def process_frame(self, frame):
+    def _grab(self):
+        start = time.monotonic()
+        frame_number = 0
+        try:
+            while not self._stop.is_set():
+                if self.simulate_fps:
+                    delay = start + frame_number / self.simulate_fps - time.monotonic()
+                    if delay > 0 and self._stop.wait(delay):
+                        break
+                read_start = time.perf_counter()
+                ret, frame = self.cap.read()
+                if not ret:
+                    break
+                if self.stage_timer is not None:
+                    self.stage_timer.add('decode', time.perf_counter() - read_start)
+                captured = time.monotonic()
+                with self._ready:
+                    if len(self._buffer) == self._buffer.maxlen:
+                        self.dropped += 1
+                    self._buffer.append((frame, captured, frame_number))
+                    self.grabbed += 1
+                    self._ready.notify()
+                frame_number += 1
+        finally:
+            with self._ready:
+                self._ended = True
+                self._ready.notify_all()
+
+class LatencyStats:
+    """Capture-to-count latency of live frames, over a window of recent frames"""
+    
+    def __init__(self, budget=1.0, window=10000):
         """
-        Process a single frame for vehicle detection and counting
-        
         Args:
-            frame: Input video frame
-            
+            budget (float): Seconds a frame may take from capture to counted
+            window (int): Recent frames the percentiles are taken over
+        """
+        self.budget = budget
+        self.count = 0
+        self.over_budget = 0
+        self.worst = 0.0
+        self._recent = deque(maxlen=window)
+    
+    def add(self, latency):
+        self.count += 1
+        self.over_budget += latency > self.budget
+        self.worst = max(self.worst, latency)
+        self._recent.append(latency)
+    
+    def summary(self):
+        """
         Returns:
-            processed_frame: Frame with annotations
+            dict: Frames measured, median and 95th percentile of the recent
+                  window, worst latency and frames over budget
         """
-        # Run YOLO inference
-        results = self.model.track(frame, persist=True, conf=self.confidence_threshold,
-                                 classes=list(self.vehicle_classes.keys()))
-        
-        annotated_frame = frame.copy()
+        recent = np.array(self._recent) if self._recent else np.zeros(1)
+        return {
+            'frames': self.count,
+            'p50': float(np.percentile(recent, 50)),
+            'p95': float(np.percentile(recent, 95)),
+            'max': self.worst,
+            'over_budget': self.over_budget,
+        }
+
+class SharedFrameRing:
+    """
+    Preallocated frame buffers in shared memory, handed between processes by slot
+    
+    A producer takes a free slot, decodes a frame straight into it and
+    publishes the slot number; the consumer works on a NumPy view of the slot
+    and releases it when done. Only slot numbers cross the process boundary,
+    never pixels. With every slot taken the producer waits, which bounds
+    memory and pushes back on decoding.
+    """
+    
+    def __init__(self, shape, slots=8, context=None, _attach=None):
+        """
+        Args:
+            shape (tuple): (height, width, channels) of every frame
+            slots (int): Number of frame buffers
+            context: multiprocessing context for the slot queues (default: spawn)
+        """
+        self.shape = tuple(shape)
+        self.slots = slots
+        size = slots * int(np.prod(self.shape))
+        if _attach is None:
+            self._memory = shared_memory.SharedMemory(create=True, size=size)
+            context = context or multiprocessing.get_context('spawn')
+            self.free = context.Queue()
+            self.filled = context.Queue()
+            for slot in range(slots):
+                self.free.put(slot)
+        else:
+            name, self.free, self.filled = _attach
+            self._memory = shared_memory.SharedMemory(name=name)
+        self._owner = _attach is None
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=self._memory.buf)
+    
+    def handle(self):
+        """Picklable arguments for attach() in another process"""
+        return self._memory.name, self.shape, self.slots, self.free, self.filled
+    
+    @classmethod
+    def attach(cls, name, shape, slots, free, filled):
+        """Open a ring created by another process"""
+        return cls(shape, slots, _attach=(name, free, filled))
+    
+    def acquire(self, timeout=None):
+        """Take a free slot to write a frame into, or None after timeout"""
+        try:
+            return self.free.get(timeout=timeout)
+        except queue.Empty:
+            return None
+    
+    def publish(self, slot):
+        """Hand a written slot to the consumer; None marks the end of the stream"""
+        self.filled.put(slot)
+    
+    def next_filled(self, timeout=None):
+        """
+        Next published slot, in publish order
         
-        if results[0].boxes is not None and results[0].boxes.id is not None:
-            # Get detection boxes, track IDs, and classes
-            boxes = results[0].boxes.xywh.cpu()
-            track_ids = results[0].boxes.id.int().cpu().tolist()
-            class_ids = results[0].boxes.cls.int().cpu().tolist()
-            confidences = results[0].boxes.conf.cpu().tolist()
-            
-            for box, track_id, class_id, conf in zip(boxes, track_ids, class_ids, confidences):
-                if class_id in self.vehicle_classes and conf >= 0.5:
-                    x, y, w, h = box
-                    if w < 30 or h < 30 or w > 400 or h > 400:
-                        continue
+        Returns:
+            int: Slot number, None at the end of the stream, or _END_OF_STREAM
+                 if nothing arrived within timeout
+        """
+        try:
+            return self.filled.get(timeout=timeout)
+        except queue.Empty:
+            return _END_OF_STREAM
+    
+    def release(self, slot):
+        """Give a slot back to the producer once nothing uses its frame any more"""
+        self.free.put(slot)
+    
+    def close(self):
+        """Unmap the buffers, and free them if this process created the ring"""
+        self.frames = None
+        try:
+            self._memory.close()
+        except BufferError:
+            # Something still holds a view (the model keeps its last batch);
+            # the mapping goes away when that does
+            pass
+        if self._owner:
+            self._memory.unlink()
 
-                    center_point = (int(x), int(y))
-                    self.track_history[track_id].append(center_point)
-                    if len(self.track_history[track_id]) > 30:
-                        self.track_history[track_id].pop(0)
-
-                    movement_threshold = 20  # pixels
-                    track_points = self.track_history[track_id]
-                    if len(track_points) > 1:
-                        dist = np.linalg.norm(np.array(track_points[-1]) - np.array(track_points[0]))
-                    else:
-                        dist = 0
-
-                    # Count vehicles already past the line at first detection, only if moved
-                    if len(track_points) == 1 and track_id not in self.counted_ids:
-                        # Don't count if not enough movement yet
-                        continue
+# Exit code of a decoder process that couldn't open its source
+_DECODER_OPEN_FAILED = 3
 
-                    if dist < movement_threshold:
-                        continue  # Ignore static objects
-
-                    if len(track_points) == 1 and track_id not in self.counted_ids:
-                        if center_point[1] > self.counting_line_y or center_point[1] < self.counting_line_y:
-                            vehicle_type = self.vehicle_classes[class_id]
-                            self.vehicle_count[vehicle_type] += 1
-                            self.total_vehicles += 1
-                            self.counted_ids.add(track_id)
-                            print(f"Vehicle #{self.total_vehicles} detected (initial): {vehicle_type} (ID: {track_id})")
-                    elif self.has_crossed_line(track_points, track_id):
-                        vehicle_type = self.vehicle_classes[class_id]
-                        self.vehicle_count[vehicle_type] += 1
-                        self.total_vehicles += 1
-                        print(f"Vehicle #{self.total_vehicles} detected: {vehicle_type} (ID: {track_id})")
-                    
-                    # Draw bounding box
-                    x1 = int(x - w/2)
-                    y1 = int(y - h/2)
-                    x2 = int(x + w/2)
-                    y2 = int(y + h/2)
-                    
-                    cv2.rectangle(annotated_frame, (x1, y1), (x2, y2), (255, 0, 0), 2)
-                    
-                    # Draw label
-                    label = f"{self.vehicle_classes[class_id]} ID:{track_id} {conf:.2f}"
-                    cv2.putText(annotated_frame, label, (x1, y1 - 10),
-                               cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
-                    
-                    # Draw track trail
-                    points = np.array(self.track_history[track_id], dtype=np.int32)
-                    if len(points) > 1:
-                        cv2.polylines(annotated_frame, [points], False, (0, 255, 255), 2)
-        
-        return annotated_frame
+def _decode_to_ring(video_path, ring_handle, stop):
+    """Decoder process: read video_path into free ring slots until it ends or stop is set"""
+    ring = SharedFrameRing.attach(*ring_handle)
+    cap = _open_source(video_path)
+    if not cap.isOpened():
+        # No end-of-stream marker: the exit code tells the parent why
+        ring.close()
+        sys.exit(_DECODER_OPEN_FAILED)
+    try:
+        while not stop.is_set():
+            slot = ring.acquire(timeout=0.1)
+            if slot is None:
+                continue
+            if not cap.grab():
+                break
+            # Decode straight into shared memory; only a resolution change needs a copy
+            view = ring.frames[slot]
+            ret, frame = cap.retrieve(view)
+            if not ret:
+                break
+            if not np.shares_memory(frame, view):
+                view[...] = cv2.resize(frame, (ring.shape[1], ring.shape[0]))
+            ring.publish(slot)
+        view = frame = None
+    finally:
+        ring.publish(None)
+        cap.release()
+        ring.close()
+
+class MultiStreamCounter:
+    """
+    Count vehicles on several videos or live streams in worker processes
     
-    def add_stats_overlay(self, frame):
-        """Add counting statistics overlay to the frame"""
-        y_offset = 30
+    Streams are split into groups of streams_per_model. Each worker process
+    loads the model once and runs one group at a time, taking frames from its
+    streams in turn; every stream keeps its own tracker, track history and
+    counts. Groups beyond the number of workers wait for a free worker, so
+    live streams need workers >= number of groups.
+    """
+    
+    def __init__(self, sources, model_path='yolov8n.pt', confidence_threshold=0.3,
+                 workers=None, streams_per_model=4, batch_size=1, line_position=0.5,
+                 movement_threshold=20, max_track_age=300,
+                 motion_gate=None, detect_every=None,
+                 inference_region=None, backend='torch', int8=False,
+                 threads=None, cpus_per_worker=None):
+        """
+        Args:
+            sources (list): Video files, stream URLs or camera indices
+            model_path (str): Path to YOLO model weights
+            confidence_threshold (float): Minimum confidence for detections
+            workers (int): Worker processes (default: one per group)
+            streams_per_model (int): Streams sharing one model instance
+            batch_size (int): Frames per stream per inference call
+            line_position (float): Counting line position as fraction of frame height
+            movement_threshold (float): Pixels a track must move to be counted
+            max_track_age (int): Frames a track can go unseen before its state is dropped
+            motion_gate (dict): MotionGate arguments to skip static frames per stream
+            detect_every (int): Run the detector every N frames with a BoxTracker in between
+            inference_region (dict): InferenceRegion arguments for ROI cropping and tiling
+            backend (str): Inference backend, one of BACKENDS
+            int8 (bool): Run the INT8-quantized model
+            threads (dict): configure_threads() arguments for each worker
+            cpus_per_worker (int): Pin each worker to its own set of this many CPUs
+        """
+        self.sources = list(sources)
+        self.model_path = model_path
+        self.streams_per_model = max(1, streams_per_model)
+        self.groups = [self.sources[i:i + self.streams_per_model]
+                       for i in range(0, len(self.sources), self.streams_per_model)]
+        self.workers = workers or len(self.groups)
+        self.settings = {
+            'confidence_threshold': confidence_threshold,
+            'batch_size': batch_size,
+            'line_position': line_position,
+            'movement_threshold': movement_threshold,
+            'max_track_age': max_track_age,
+            'model_path': model_path,
+            'motion_gate': motion_gate,
+            'detect_every': detect_every,
+            'inference_region': inference_region,
+            'backend': backend,
+            'int8': int8,
+        }
+        self.threads = threads
+        self.cpus_per_worker = cpus_per_worker
+    
+    def _exported_model_path(self):
+        # Export once here rather than racing to export in every worker
+        return export_model(self.model_path, self.settings['backend'], self.settings['int8'])
+    
+    def run(self):
+        """
+        Count every stream to its end
         
-        # Total count (changed color to red)
-        cv2.putText(frame, f"Total Vehicles: {self.total_vehicles}", 
-                   (10, y_offset), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)  # (0, 0, 255) is red
-        y_offset += 30
+        Returns:
+            dict: Source -> final counts, frames processed and counting events
+        """
+        print(f"Counting {len(self.sources)} streams: {len(self.groups)} model instances "
+              f"on {self.workers} worker processes")
         
-        # Individual vehicle type counts
-        for vehicle_type, count in self.vehicle_count.items():
-            text = f"{vehicle_type.capitalize()}: {count}"
-            cv2.putText(frame, text, (10, y_offset), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-            y_offset += 25
-            
-        return frame
+        results = {}
+        # Spawned workers don't inherit the parent's torch/OpenCV thread pools
+        context = multiprocessing.get_context('spawn')
+        with _stream_worker_pool(context, self.workers, self._exported_model_path(),
+                                 self.threads, self.cpus_per_worker) as pool:
+            for group_results in pool.imap_unordered(_count_stream_group,
+                                                     [(group, self.settings) for group in self.groups]):
+                for source, summary in group_results.items():
+                    print(f"{source}: {summary['total_vehicles']} vehicles in {summary['frames']} frames")
+                results.update(group_results)
+        return results
+
+# Model loaded once per MultiStreamCounter worker process
+_worker_model = None
+
+def _stream_worker_pool(context, workers, model_path, threads=None, cpus_per_worker=None):
+    """Worker processes that each set up their threads and CPUs, then load the model"""
+    cpu_sets = None
+    if cpus_per_worker:
+        cpu_sets = cpu_slices(workers, cpus_per_worker)
+        if len({cpu for cpu_set in cpu_sets for cpu in cpu_set}) < workers * cpus_per_worker:
+            print(f"Fewer than {workers * cpus_per_worker} CPUs available: pinned workers share CPUs")
+    next_worker = context.Value('i', 0)
+    return context.Pool(workers, initializer=_init_stream_worker,
+                        initargs=(model_path, threads, cpu_sets, next_worker))
+
+def _init_stream_worker(model_path, threads=None, cpu_sets=None, next_worker=None):
+    global _worker_model
+    threads = dict(threads or {})
+    if cpu_sets:
+        with next_worker.get_lock():
+            index = next_worker.value
+            next_worker.value += 1
+        cpus = cpu_sets[index % len(cpu_sets)]
+        threads['cpus'] = cpus
+        # Unless told otherwise, one inference thread per pinned CPU
+        if not threads.get('intra_op'):
+            threads['intra_op'] = len(cpus)
+    configure_threads(**threads)
+    # model_path is already exported for the backend, see _exported_model_path
+    _worker_model = load_model(model_path)
+
+def _open_source(source):
+    """Open a video file, stream URL or camera index ("0") for reading"""
+    return cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+
+def _missing_files(sources):
+    """Sources that are neither camera indexes nor URLs and don't exist as files"""
+    return [source for source in sources
+            if not str(source).isdigit() and '://' not in str(source)
+            and not os.path.exists(source)]
+
+def _worker_counter(cap, settings):
+    """VehicleCounter on this worker's shared model, set up for the capture's frames"""
+    counter = VehicleCounter(model_path=settings['model_path'], model=_worker_model,
+                             confidence_threshold=settings['confidence_threshold'],
+                             max_track_age=settings['max_track_age'],
+                             backend=settings['backend'], int8=settings['int8'])
+    counter.movement_threshold = settings['movement_threshold']
+    if settings.get('motion_gate') is not None:
+        counter.motion_gate = MotionGate(**settings['motion_gate'])
+    if settings.get('detect_every') is not None:
+        counter.box_tracker = BoxTracker(settings['detect_every'])
+    if settings.get('inference_region') is not None:
+        counter.inference_region = InferenceRegion(**settings['inference_region'])
+    counter.setup_counting_line(int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                                settings['line_position'])
+    return counter
+
+def _count_stream_group(task):
+    """Count a group of streams on this worker's model, taking turns per batch"""
+    sources, settings = task
+    streams = {}
+    for source in sources:
+        cap = _open_source(source)
+        if not cap.isOpened():
+            print(f"Could not open video source: {source}")
+            continue
+        streams[source] = (cap, _worker_counter(cap, settings), [])
+    
+    frame_counts = defaultdict(int)
+    active = list(streams)
+    try:
+        while active:
+            for source in list(active):
+                cap, counter, events = streams[source]
+                frames = _read_frames(cap, settings['batch_size'])
+                if frames:
+                    for result in counter.detect_and_count_batch(frames, annotate=False):
+                        events.extend(result.events)
+                    frame_counts[source] += len(frames)
+                if len(frames) < settings['batch_size']:
+                    active.remove(source)
+    finally:
+        for cap, _, _ in streams.values():
+            cap.release()
     
-    def process_video(self, video_path, output_path=None, display_video=True):
+    return {
+        source: {
+            'total_vehicles': counter.total_vehicles,
+            'vehicle_count': dict(counter.vehicle_count),
+            'frames': frame_counts[source],
+            'events': events,
+        }
+        for source, (_, counter, events) in streams.items()
+    }
+
+class ChunkedVideoCounter:
+    """
+    Count one long video by processing overlapping time segments in parallel
+    
+    The video is cut into segments that worker processes count at the same
+    time, each seeking to its own start. Every worker begins overlap_seconds
+    early so its tracker and track history are warmed up by the segment
+    start, but only keeps counting events whose frame falls inside its own
+    segment. Each crossing therefore belongs to exactly one segment, and the
+    stitched result is the events of all segments in frame order.
+    
+    Tolerance: with an overlap longer than the tracker's warm-up and the
+    track history (the 5 s default is both), segments see the same crossings
+    as a serial run. A vehicle that stays in view across a boundary for more
+    than the overlap can still differ by one, so the total matches the serial
+    run within +/-1 vehicle per segment boundary.
+    """
+    
+    def __init__(self, video_path, model_path='yolov8n.pt', confidence_threshold=0.3,
+                 workers=None, segments=None, overlap_seconds=5.0, batch_size=1,
+                 line_position=0.5, movement_threshold=20, max_track_age=300,
+                 motion_gate=None, detect_every=None,
+                 inference_region=None, backend='torch', int8=False,
+                 threads=None, cpus_per_worker=None):
         """
-        Process entire video for vehicle counting
-        
         Args:
             video_path (str): Path to input video file
-            output_path (str): Path to save output video (optional)
-            display_video (bool): Whether to display video in real-time
+            model_path (str): Path to YOLO model weights
+            confidence_threshold (float): Minimum confidence for detections
+            workers (int): Worker processes (default: CPU count)
+            segments (int): Number of segments (default: one per worker)
+            overlap_seconds (float): Warm-up each segment gets before its start
+            batch_size (int): Frames per inference call
+            line_position (float): Counting line position as fraction of frame height
+            movement_threshold (float): Pixels a track must move to be counted
+            max_track_age (int): Frames a track can go unseen before its state is dropped
+            motion_gate (dict): MotionGate arguments to skip static frames per segment
+            detect_every (int): Run the detector every N frames with a BoxTracker in between
+            inference_region (dict): InferenceRegion arguments for ROI cropping and tiling
+            backend (str): Inference backend, one of BACKENDS
+            int8 (bool): Run the INT8-quantized model
+            threads (dict): configure_threads() arguments for each worker
+            cpus_per_worker (int): Pin each worker to its own set of this many CPUs
+        """
+        self.video_path = video_path
+        self.model_path = model_path
+        self.workers = workers or os.cpu_count()
+        self.segments = segments or self.workers
+        self.overlap_seconds = overlap_seconds
+        self.settings = {
+            'confidence_threshold': confidence_threshold,
+            'batch_size': batch_size,
+            'line_position': line_position,
+            'movement_threshold': movement_threshold,
+            'max_track_age': max_track_age,
+            'model_path': model_path,
+            'motion_gate': motion_gate,
+            'detect_every': detect_every,
+            'inference_region': inference_region,
+            'backend': backend,
+            'int8': int8,
+        }
+        self.threads = threads
+        self.cpus_per_worker = cpus_per_worker
+    
+    def _exported_model_path(self):
+        # Export once here rather than racing to export in every worker
+        return export_model(self.model_path, self.settings['backend'], self.settings['int8'])
+    
+    def run(self):
         """
-        cap = cv2.VideoCapture(video_path)
+        Count the whole video
         
+        Returns:
+            dict: Final counts, frames processed, stitched counting events, the
+                  segment boundaries used and the +/- count tolerance
+        """
+        cap = cv2.VideoCapture(self.video_path)
         if not cap.isOpened():
-            raise ValueError(f"Could not open video file: {video_path}")
-        
-        # Get video properties
-        fps = int(cap.get(cv2.CAP_PROP_FPS))
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            raise ValueError(f"Could not open video file: {self.video_path}")
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
         
-        print(f"Processing video: {width}x{height} @ {fps}fps, {total_frames} frames")
+        # Segment i covers [bounds[i], bounds[i + 1]); the last one runs to the end
+        segments = max(1, min(self.segments, total_frames))
+        bounds = [total_frames * i // segments for i in range(segments)] + [None]
+        overlap = int(round(self.overlap_seconds * fps))
+        tasks = [(self.video_path, bounds[i], bounds[i + 1], overlap, self.settings)
+                 for i in range(segments)]
         
-        # Setup counting line (middle of frame by default)
-        self.setup_counting_line(height)
+        print(f"Counting {self.video_path} in {segments} segments of ~{total_frames // segments} "
+              f"frames with {overlap} frames overlap on {self.workers} workers")
         
-        # Setup video writer if output path is provided
-        out = None
-        if output_path:
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+        context = multiprocessing.get_context('spawn')
+        with _stream_worker_pool(context, min(self.workers, segments),
+                                 self._exported_model_path(), self.threads,
+                                 self.cpus_per_worker) as pool:
+            segment_results = pool.map(_count_segment, tasks)
         
-        frame_count = 0
-        start_time = time.time()
+        # Stitch: every event belongs to exactly one segment
+        events = sorted((event for result in segment_results for event in result['events']),
+                        key=lambda event: event['frame'])
+        vehicle_count = defaultdict(int)
+        for total, event in enumerate(events, 1):
+            vehicle_count[event['vehicle_type']] += 1
+            event['total'] = total
         
+        return {
+            'total_vehicles': len(events),
+            'vehicle_count': dict(vehicle_count),
+            'frames': sum(result['frames'] for result in segment_results),
+            'events': events,
+            'segment_starts': bounds[:-1],
+            'tolerance': segments - 1,
+        }
+
+def _count_segment(task):
+    """Count the events of one segment, warming up on the overlap before it"""
+    video_path, start, end, overlap, settings = task
+    cap = cv2.VideoCapture(video_path)
+    warm_start = max(0, start - overlap)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, warm_start)
+    counter = _worker_counter(cap, settings)
+    
+    # Number frames from the start of the video so events stitch together
+    counter.frame_index = warm_start - 1
+    position = warm_start
+    events = []
+    try:
+        while end is None or position < end:
+            count = settings['batch_size'] if end is None else min(settings['batch_size'], end - position)
+            frames = _read_frames(cap, count)
+            if not frames:
+                break
+            for result in counter.detect_and_count_batch(frames, annotate=False):
+                events.extend(event for event in result.events if event['frame'] >= start)
+            position += len(frames)
+            if len(frames) < count:
+                break
+    finally:
+        cap.release()
+    
+    return {'events': events, 'frames': max(0, position - start)}
+
+# Marks the end of the frame stream between pipeline stages
+_END_OF_STREAM = object()
+
+def _put_until_stopped(q, item, stop):
+    """Put an item on a bounded queue, giving up once stop is set"""
+    while not stop.is_set():
         try:
-            while True:
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                
-                frame_count += 1
-                
-                # Process frame for vehicle detection and counting
-                processed_frame = self.process_frame(frame)
-                
-                # Add counting line and statistics
-                self.draw_counting_line(processed_frame)
-                processed_frame = self.add_stats_overlay(processed_frame)
-                
-                # Save frame if output video is specified
-                if out:
-                    out.write(processed_frame)
-                
-                # Display video if requested
-                if display_video:
-                    cv2.imshow('Vehicle Counter', processed_frame)
-                    if cv2.waitKey(1) & 0xFF == ord('q'):
-                        print("Interrupted by user")
-                        break
-                
-                # Progress update
-                if frame_count % (fps * 5) == 0:  # Every 5 seconds
-                    elapsed = time.time() - start_time
-                    progress = (frame_count / total_frames) * 100
-                    print(f"Progress: {progress:.1f}% - {self.total_vehicles} vehicles counted - "
-                          f"Processing speed: {frame_count/elapsed:.1f} fps")
-        
-        except KeyboardInterrupt:
-            print("Processing interrupted by user")
-        
-        finally:
-            # Cleanup
-            cap.release()
-            if out:
-                out.release()
-            if display_video:
-                cv2.destroyAllWindows()
-            
-            # Print final results
-            self.print_final_results()
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get_until_stopped(q, stop):
+    """Get an item from a queue, returning end-of-stream once stop is set"""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _END_OF_STREAM
+
+class _Progress:
+    """Prints progress and processing speed every 5 seconds of video"""
     
-    def print_final_results(self):
-        """Print final counting results"""
-        print("\n" + "="*50)
-        print("FINAL VEHICLE COUNT RESULTS")
-        print("="*50)
-        print(f"Total Vehicles Counted: {self.total_vehicles}")
-        print("-" * 30)
-        
-        for vehicle_type, count in self.vehicle_count.items():
-            percentage = (count / self.total_vehicles * 100) if self.total_vehicles > 0 else 0
-            print(f"{vehicle_type.capitalize()}: {count} ({percentage:.1f}%)")
-        
-        print("="*50)
+    def __init__(self, fps, total_frames):
+        # Cameras can report 0 fps; fall back to a typical rate for the interval
+        self.fps = fps if fps > 0 else 30
+        self.total_frames = total_frames
+        self.frame_count = 0
+        self.start_time = time.time()
+    
+    def update(self, total_vehicles):
+        self.frame_count += 1
+        if self.frame_count % (self.fps * 5) == 0:  # Every 5 seconds
+            elapsed = time.time() - self.start_time
+            if self.total_frames > 0:
+                progress = (self.frame_count / self.total_frames) * 100
+                print(f"Progress: {progress:.1f}% - {total_vehicles} vehicles counted - "
+                      f"Processing speed: {self.frame_count/elapsed:.1f} fps")
+            else:
+                # Live sources have no length
+                print(f"Frames: {self.frame_count} - {total_vehicles} vehicles counted - "
+                      f"Processing speed: {self.frame_count/elapsed:.1f} fps")
+
+def sweep_lines(counter, args):
+    """Print counts for each --sweep-lines position using cached tracker output"""
+    if not args.cache_dir:
+        print("--sweep-lines needs --cache-dir")
+        return 1
+    
+    try:
+        tracks = counter.load_cached_tracks(args.video_path, args.cache_dir)
+        positions = [float(position) for position in args.sweep_lines.split(',')]
+        lines = [CountingLine.horizontal(int(tracks.height * position), tracks.width,
+                                         name=f"{position:g}")
+                 for position in positions]
+        results = count_line_crossings(counter.track_steps(tracks), lines,
+                                       counter.vehicle_classes)
+    except Exception as e:
+        print(f"Error sweeping counting lines: {e}")
+        return 1
+    
+    print(f"{'Line':>8} {'Total':>7}  Per type")
+    for result in results:
+        per_type = ", ".join(f"{vehicle_type}: {count}"
+                             for vehicle_type, count in result['vehicle_count'].items())
+        print(f"{result['line']:>8} {result['total_vehicles']:>7}  {per_type}")
+    return 0
+
+def count_streams(args):
+    """Count several videos or streams with MultiStreamCounter"""
+    if args.output or args.clips or not args.no_display:
+        print("Several streams are counted without display, output video or clips")
+    
+    counter = MultiStreamCounter(args.video_path, model_path=args.model,
+                                 confidence_threshold=args.confidence,
+                                 workers=args.workers,
+                                 streams_per_model=args.streams_per_model,
+                                 batch_size=args.batch_size,
+                                 line_position=args.line_position,
+                                 movement_threshold=args.movement_threshold,
+                                 max_track_age=args.max_track_age,
+                                 motion_gate=args.motion_gate_settings,
+                                 detect_every=args.detect_every,
+                                 inference_region=args.inference_region,
+                                 backend=args.backend, int8=args.int8,
+                                 threads=args.threads, cpus_per_worker=args.cpus_per_worker)
+    try:
+        results = counter.run()
+    except Exception as e:
+        print(f"Error processing streams: {e}")
+        return 1
+    
+    if args.events:
+        # Workers hand their events back at the end, so they are written in one go
+        sink = EventSink(args.events, args.snapshot_interval)
+        for source, summary in results.items():
+            sink.write(summary['events'], source)
+            sink.update(summary['frames'], (summary['total_vehicles'], summary['vehicle_count']),
+                        source, force=True)
+        sink.close()
+    
+    print("\n" + "="*50)
+    print("FINAL VEHICLE COUNT RESULTS")
+    print("="*50)
+    for source in args.video_path:
+        if source in results:
+            print(f"{source}: {results[source]['total_vehicles']} vehicles "
+                  f"{results[source]['vehicle_count']}")
+    print("="*50)
+    return 0
+
+def count_chunked(args):
+    """Count one video in parallel segments with ChunkedVideoCounter"""
+    if args.output or args.clips or not args.no_display:
+        print("Chunked counting runs without display, output video or clips")
+    
+    counter = ChunkedVideoCounter(args.video_path, model_path=args.model,
+                                  confidence_threshold=args.confidence,
+                                  workers=args.workers, segments=args.chunks,
+                                  overlap_seconds=args.overlap_seconds,
+                                  batch_size=args.batch_size,
+                                  line_position=args.line_position,
+                                  movement_threshold=args.movement_threshold,
+                                  max_track_age=args.max_track_age,
+                                  motion_gate=args.motion_gate_settings,
+                                  detect_every=args.detect_every,
+                                  inference_region=args.inference_region,
+                                  backend=args.backend, int8=args.int8,
+                                  threads=args.threads, cpus_per_worker=args.cpus_per_worker)
+    try:
+        result = counter.run()
+    except Exception as e:
+        print(f"Error processing video: {e}")
+        return 1
+    
+    if args.events:
+        sink = EventSink(args.events, args.snapshot_interval)
+        sink.write(result['events'])
+        sink.update(result['frames'], (result['total_vehicles'], result['vehicle_count']),
+                    force=True)
+        sink.close()
+    
+    print("\n" + "="*50)
+    print("FINAL VEHICLE COUNT RESULTS")
+    print("="*50)
+    print(f"Total Vehicles Counted: {result['total_vehicles']} "
+          f"(+/-{result['tolerance']} at segment boundaries)")
+    print("-" * 30)
+    for vehicle_type, count in result['vehicle_count'].items():
+        print(f"{vehicle_type.capitalize()}: {count}")
+    print("="*50)
+    return 0
 
 def main():
     """Main function to run the vehicle counter"""
     parser = argparse.ArgumentParser(description='Count vehicles in video')
-    parser.add_argument('video_path', help='Path to input video file')
+    parser.add_argument('video_path', nargs='+',
+                       help='Path to input video file; several files or streams are '
+                            'counted in worker processes')
     parser.add_argument('--output', '-o', help='Path to output video file')
+    parser.add_argument('--clips',
+                       help='Write short annotated clips around counting events to this '
+                            'directory instead of a whole output video')
+    parser.add_argument('--clip-trigger', choices=ClipRecorder.TRIGGERS, default='events',
+                       help='Start a clip on counting events or on any moving vehicle '
+                            '(default: events)')
+    parser.add_argument('--clip-pre', type=float, default=2.0,
+                       help='Seconds of video kept before a clip\'s first trigger (default: 2)')
+    parser.add_argument('--clip-post', type=float, default=3.0,
+                       help='Seconds of video kept after a clip\'s last trigger (default: 3)')
+    parser.add_argument('--clip-encode-process', action='store_true',
+                       help='Encode clips in a separate process')
     parser.add_argument('--model', '-m', default='yolov8n.pt', 
                        help='Path to YOLO model weights (default: yolov8n.pt)')
+    parser.add_argument('--backend', choices=BACKENDS, default='torch',
+                       help='Inference runtime; onnx and openvino models are exported '
+                            'next to the weights on first use (default: torch)')
+    parser.add_argument('--int8', action='store_true',
+                       help='Use an INT8-quantized model (onnx or openvino backend)')
     parser.add_argument('--confidence', '-c', type=float, default=0.3,
                        help='Confidence threshold for detections (default: 0.3)')
     parser.add_argument('--no-display', action='store_true',
                        help='Do not display video during processing')
+    parser.add_argument('--pipelined', action='store_true',
+                       help='Run decode, inference and encode as parallel stages')
+    parser.add_argument('--live', action='store_true',
+                       help='Live camera/RTSP source: count the newest frames, dropping stale ones')
+    parser.add_argument('--live-buffer', type=int, default=1,
+                       help='Newest frames kept for a live source (default: 1)')
+    parser.add_argument('--simulate-live', action='store_true',
+                       help='Play a video file back in real time as a live source')
+    parser.add_argument('--latency-budget', type=float, default=1.0,
+                       help='Seconds a live frame may take from capture to counted (default: 1)')
+    parser.add_argument('--decode-process', action='store_true',
+                       help='Decode in a separate process, passing frames through shared memory')
+    parser.add_argument('--queue-size', type=int, default=8,
+                       help='Frames buffered between pipeline stages (default: 8)')
+    parser.add_argument('--batch-size', type=int, default=1,
+                       help='Frames per model inference call (default: 1)')
+    parser.add_argument('--cache-dir',
+                       help='Cache tracker output here and replay it on later runs of the same video')
+    parser.add_argument('--line-position', type=float, default=0.5,
+                       help='Counting line position as fraction of frame height (default: 0.5)')
+    parser.add_argument('--sweep-lines',
+                       help='Comma-separated line positions (fractions of frame height) to count '
+                            'from the cache in one pass instead of processing the video')
+    parser.add_argument('--movement-threshold', type=float, default=20,
+                       help='Pixels a track must move before it can be counted (default: 20)')
+    parser.add_argument('--max-track-age', type=int, default=300,
+                       help='Frames a track can go unseen before its state is dropped (default: 300)')
+    parser.add_argument('--workers', type=int,
+                       help='Worker processes for several streams (default: one per model instance)')
+    parser.add_argument('--streams-per-model', type=int, default=4,
+                       help='Streams sharing one model instance (default: 4)')
+    parser.add_argument('--motion-gate', action='store_true',
+                       help='Skip inference on frames where nothing moved')
+    parser.add_argument('--motion-roi',
+                       help='Region the motion gate watches as x1,y1,x2,y2 fractions of the frame')
+    parser.add_argument('--detect-every', type=int,
+                       help='Run the detector every N frames and track in between with the '
+                            'built-in NumPy tracker instead of the model\'s tracker')
+    parser.add_argument('--roi', action='append',
+                       help='ROI polygon to run the detector on, as x,y;x,y;... fractions of '
+                            'the frame; repeat for several polygons')
+    parser.add_argument('--tile-size', type=int,
+                       help='Detect on overlapping tiles of this many pixels and merge them; '
+                            'uses the built-in tracker')
+    parser.add_argument('--tile-overlap', type=float, default=0.2,
+                       help='Fraction of each tile shared with its neighbour (default: 0.2)')
+    parser.add_argument('--target-latency', type=float,
+                       help='Inference seconds allowed per frame; lowers the model input size '
+                            'while over it and raises it again when there is room')
+    parser.add_argument('--imgsz-sizes', default='320,416,512,640',
+                       help='Model input sizes the target latency chooses from '
+                            '(default: 320,416,512,640)')
+    parser.add_argument('--max-stride', type=int, default=1,
+                       help='Once at the smallest input size, run inference on only one in up '
+                            'to this many frames to meet the target latency (default: 1)')
+    parser.add_argument('--events',
+                       help='Write counting events to this .jsonl, .csv or .parquet file, '
+                            'with count snapshots next to it')
+    parser.add_argument('--snapshot-interval', type=float, default=10.0,
+                       help='Seconds between count snapshots in the events output (default: 10)')
+    parser.add_argument('--warmup', type=int, default=1,
+                       help='Detector runs on a blank frame before counting, kept out of '
+                            'the processing speed (default: 1, 0 to skip)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                       help='Print every counted vehicle and the model\'s per-frame log')
+    parser.add_argument('--checkpoint',
+                       help='Save counting state to this file periodically, for --resume')
+    parser.add_argument('--checkpoint-every', type=float, default=60.0,
+                       help='Seconds of video between checkpoints (default: 60)')
+    parser.add_argument('--resume', action='store_true',
+                       help='Continue from the --checkpoint file if it exists')
+    parser.add_argument('--metrics-port', type=int,
+                       help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--threads', type=int,
+                       help='Threads torch uses within an operator, per process or worker '
+                            '(default: Ultralytics\' choice of up to 8)')
+    parser.add_argument('--interop-threads', type=int,
+                       help='Threads torch runs independent operators on (default: torch\'s)')
+    parser.add_argument('--opencv-threads', type=int,
+                       help='OpenCV worker threads, 0 for single-threaded (default: OpenCV\'s)')
+    parser.add_argument('--cpus',
+                       help='Pin to these CPUs, e.g. 0-3,8; workers are split within them')
+    parser.add_argument('--cpus-per-worker', type=int,
+                       help='Pin each stream or chunk worker to its own set of this many CPUs '
+                            'and give it that many inference threads')
+    parser.add_argument('--chunks', type=int,
+                       help='Split one video into this many segments counted in parallel')
+    parser.add_argument('--overlap-seconds', type=float, default=5.0,
+                       help='Warm-up before each parallel segment (default: 5)')
     
     args = parser.parse_args()
     
-    # Create vehicle counter instance
+    # Fail before paying for the model
+    missing = _missing_files(args.video_path)
+    if missing:
+        print(f"Video file not found: {', '.join(missing)}")
+        return 1
+    
+    # Before anything imports torch; workers apply args.threads themselves
+    args.threads = {'intra_op': args.threads, 'inter_op': args.interop_threads,
+                    'opencv': args.opencv_threads}
+    configure_threads(cpus=parse_cpu_list(args.cpus) if args.cpus else None,
+                      **(args.threads if len(args.video_path) == 1 and not args.chunks else {}))
+    
+    args.motion_gate_settings = None
+    if args.motion_gate:
+        roi = [float(value) for value in args.motion_roi.split(',')] if args.motion_roi else None
+        args.motion_gate_settings = {'roi': roi}
+    
+    args.inference_region = None
+    if args.roi or args.tile_size:
+        polygons = [[[float(value) for value in point.split(',')] for point in polygon.split(';')]
+                    for polygon in args.roi or []]
+        args.inference_region = {'polygons': polygons, 'tile_size': args.tile_size,
+                                 'tile_overlap': args.tile_overlap}
+        if args.tile_size and args.detect_every is None:
+            # Tiles are merged into plain detections, which model.track can't take
+            args.detect_every = 1
+    
+    if len(args.video_path) > 1:
+        return count_streams(args)
+    args.video_path = args.video_path[0]
+    if args.chunks:
+        return count_chunked(args)
+    
+    # Create vehicle counter instance. A line sweep only replays cached
+    # tracker output, keyed by the model path and backend, so it gets a
+    # placeholder instead of loading (or exporting) the model
     counter = VehicleCounter(model_path=args.model, 
-                           confidence_threshold=args.confidence)
+                           confidence_threshold=args.confidence,
+                           max_track_age=args.max_track_age,
+                           model=object() if args.sweep_lines else None,
+                           backend=args.backend, int8=args.int8)
+    counter.movement_threshold = args.movement_threshold
+    counter.latency_budget = args.latency_budget
+    counter.verbose = args.verbose
+    counter.warmup_runs = args.warmup
+    if args.motion_gate_settings is not None:
+        counter.motion_gate = MotionGate(**args.motion_gate_settings)
+    if args.detect_every is not None:
+        counter.box_tracker = BoxTracker(args.detect_every)
+    if args.inference_region is not None:
+        counter.inference_region = InferenceRegion(**args.inference_region)
+    if args.target_latency:
+        counter.adaptive_resolution = AdaptiveResolution(
+            args.target_latency, [int(size) for size in args.imgsz_sizes.split(',')],
+            args.max_stride)
+    if args.clips:
+        counter.clip_recorder = ClipRecorder(args.clips, args.clip_pre, args.clip_post,
+                                             args.clip_trigger, args.clip_encode_process,
+                                             stage_timer=counter.stage_timer)
     
+    if args.sweep_lines:
+        return sweep_lines(counter, args)
+    
+    metrics = None
     try:
+        if args.events:
+            counter.event_sink = EventSink(args.events, args.snapshot_interval)
+        if args.metrics_port:
+            metrics = MetricsServer(counter, args.metrics_port).start()
+            print(f"Serving metrics on http://127.0.0.1:{metrics.port}/metrics")
+        
         # Process the video
-        counter.process_video(
+        result = counter.process_video(
             video_path=args.video_path,
             output_path=args.output,
-            display_video=not args.no_display
+            display_video=not args.no_display,
+            pipelined=args.pipelined,
+            queue_size=args.queue_size,
+            batch_size=args.batch_size,
+            cache_dir=args.cache_dir,
+            line_position=args.line_position,
+            decode_process=args.decode_process,
+            live=args.live,
+            live_buffer=args.live_buffer,
+            simulate_live=args.simulate_live,
+            checkpoint_path=args.checkpoint,
+            checkpoint_every=args.checkpoint_every,
+            resume=args.resume
         )
+        timing = result['timing']
+        startup = time.perf_counter() - timing['processing'] - _STARTED_AT
+        print(f"Startup: {startup:.2f}s (model load {timing['model_load']:.2f}s, "
+              f"warm-up {timing['warm_up']:.2f}s); processing: {result['frames']} frames in "
+              f"{timing['processing']:.2f}s ({result['frames'] / max(timing['processing'], 1e-9):.1f} fps)")
     except Exception as e:
         print(f"Error processing video: {e}")
         return 1
+    finally:
+        if metrics is not None:
+            metrics.stop()
+        if counter.event_sink is not None:
+            counter.event_sink.close()
+            print(f"Counting events written to {counter.event_sink.path}")
     
     return 0
 